@@ -0,0 +1,254 @@
+# Columnar (Parquet) output for batch results, alongside the JSON written by
+# the metric scripts.
+#
+# Each metric family is flattened into a table with one row per AOI (one row
+# per AOI and species for region_metrics_iucn) and one column per value, with
+# nested keys joined by dots, e.g. "lc_transition_hectares.for-gra" or
+# "degradation.entire range.stable". The columns and types of each family are
+# declared in SCHEMAS; numbers are stored as doubles and strings are
+# dictionary-encoded. Rows are written in row groups as they come, so memory
+# use does not grow with the number of AOIs.
+#
+#  Takes the job queue of a worker pool (see worker.py) and an output
+# directory, and writes one <family>.parquet file per metric family from the
+# completed jobs. The results are read twice: once to find the columns of each
+# family, then to write them. If writing fails, no partial files are left:
+#
+#     python columnar.py jobs.db parquet_output --row-group-size 1000
+#
+# Requires pyarrow.
+
+import os
+import json
+import numbers
+import argparse
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from worker import JobQueue
+
+ROW_GROUP_SIZE = 1000
+
+try:
+    type_str = basestring
+except NameError:
+    type_str = str
+
+DOUBLE = pa.float64()
+STRING = pa.dictionary(pa.int32(), pa.string())
+
+
+def doubles(prefix, names):
+    return [(prefix + '.' + name, DOUBLE) for name in names]
+
+
+DEG_FIELDS = ['nodata', 'degraded', 'stable', 'improved']
+LC_FIELDS = ['forest', 'grassland', 'agriculture', 'wetlands', 'artificial', 'other land-bare', 'water']
+LC_ABBREVIATIONS = ['for', 'gra', 'agr', 'wet', 'art', 'oth', 'wat']
+LIVELIHOOD_FIELDS = ['Agro-Forestry', 'Agro-Pastoral', 'Arid', 'Crops - Floodzone', 'Crops - Irrigated',
+                     'Crops - Rainfed', 'Fishery', 'Forest-Based', 'National Park', 'Other', 'Pastoral',
+                     'Urban']
+ES_FIELDS = ['none', 'carbon', 'nature-basedtourism', 'culture-basedtourism', 'water', 'hazardmitigation',
+             'commercialtimber', 'domestictimber', 'commercialfisheries', 'artisanalfisheries', 'fuelwood',
+             'grazing', 'non-woodforestproducts', 'wildlifedis-services', 'wildlifeservices',
+             'environmentalquality']
+INTERVENTIONS = ['forest restoration', 'forest re-establishment', 'agricultural intensification',
+                 'agricultural expansion']
+INTERVENTION_FIELDS = ['area_hectares', 'area_habitat_hectares', 'co2_tons_per_yr', 'dollars_benefits_total',
+                       'dollars_cost_total', 'dollars_net_per_psn_per_yr']
+
+# Declared columns of each metric family, after the aoi column. Other columns
+# found in the first row group (e.g. IUCN range attributes) are added with the
+# type of their values.
+SCHEMAS = {
+    'region_metrics':
+        [(name, DOUBLE) for name in ['area_hectares', 'population', 'soc_change_percent',
+                                     'soc_change_tons_co2e', 'ecosystem_service_value']] +
+        doubles('livelihoods', LIVELIHOOD_FIELDS) +
+        sum([doubles(key, DEG_FIELDS) for key in ['area_sdg', 'area_lc', 'area_prod', 'prod_forests',
+                                                  'prod_grasslands', 'prod_agriculture']], []) +
+        doubles('area_soc', ['no data', 'degraded', 'stable', 'improved']) +
+        doubles('lc_2001', LC_FIELDS) +
+        doubles('lc_2015', LC_FIELDS) +
+        doubles('lc_transition_hectares', ['{}-{}'.format(a, b) for a in LC_ABBREVIATIONS
+                                           for b in LC_ABBREVIATIONS]) +
+        doubles('ecosystem_service_dominant', ES_FIELDS),
+    'region_metrics_emissions':
+        [(name, DOUBLE) for name in ['carbon_emissions_tons_co2e', 'forest_area_hectares_2001',
+                                     'forest_area_hectares_2015', 'forest_area_percent_2001',
+                                     'forest_area_percents_2015']],
+    'restoration_metrics':
+        [(name, DOUBLE) for name in ['area_hectares', 'population', 'forest_loss',
+                                     'ecosystem_service_value']] +
+        doubles('area_sdg', DEG_FIELDS) +
+        sum([doubles('interventions.' + i, INTERVENTION_FIELDS) for i in INTERVENTIONS], []) +
+        doubles('ecosystem_service_dominant', ES_FIELDS),
+    'region_metrics_iucn':
+        [('binomial', STRING), ('code', STRING)] +
+        doubles('degradation.aoi', DEG_FIELDS) +
+        doubles('degradation.entire range', DEG_FIELDS)
+}
+
+
+def flatten(d, prefix=''):
+    ret = {}
+    for key, value in d.items():
+        if isinstance(value, dict):
+            ret.update(flatten(value, prefix + key + '.'))
+        else:
+            ret[prefix + key] = value
+    return ret
+
+
+def get_rows(family, name, result):
+    # Rows for the result of one AOI
+    if family == 'region_metrics_iucn':
+        for species in result['iucn_mammals']:
+            row = flatten(species)
+            row['aoi'] = name
+            yield row
+    else:
+        row = flatten(result)
+        row['aoi'] = name
+        yield row
+
+
+def get_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, numbers.Number):
+        return 'number'
+    return 'string'
+
+
+def kinds_to_type(kinds):
+    # Type of an undeclared column from the kinds of its values. Columns with
+    # no values, or with values of several kinds, are stored as strings, which
+    # any value can be converted to.
+    if kinds == set(['bool']):
+        return pa.bool_()
+    if kinds == set(['number']):
+        return DOUBLE
+    return STRING
+
+
+def get_type(values):
+    return kinds_to_type(set(get_kind(v) for v in values if v is not None))
+
+
+def get_columns(family, kinds):
+    # Declared columns of a family, followed by the other columns found in its
+    # rows, given the kinds of values of each column
+    columns = list(SCHEMAS.get(family, []))
+    declared = set(name for name, type in columns) | set(['aoi'])
+    columns += [(name, kinds_to_type(kinds[name])) for name in sorted(kinds) if name not in declared]
+    return columns
+
+
+def scan_columns(results):
+    # Kinds of values of each column of each family, from (family, name,
+    # result) tuples
+    kinds = {}
+    for family, name, result in results:
+        family_kinds = kinds.setdefault(family, {})
+        for row in get_rows(family, name, json.loads(result)):
+            for key, value in row.items():
+                column_kinds = family_kinds.setdefault(key, set())
+                if value is not None:
+                    column_kinds.add(get_kind(value))
+    return kinds
+
+
+def to_array(values, type):
+    if pa.types.is_dictionary(type):
+        values = [None if v is None else (v if isinstance(v, type_str) else json.dumps(v))
+                  for v in values]
+        return pa.array(values, type=pa.string()).dictionary_encode()
+    return pa.array(values, type=type)
+
+
+class ColumnarWriter(object):
+    """Writes result rows to a Parquet file in row groups.
+
+    The schema is made of the aoi column, the declared columns, and any other
+    columns found in the first row group. Columns missing from rows are left
+    null. Columns that first appear in later row groups, and values that don't
+    match the type of their column, raise an error rather than being dropped.
+    """
+    def __init__(self, path, columns=None, row_group_size=ROW_GROUP_SIZE):
+        self.path = path
+        self.columns = columns or []
+        self.row_group_size = row_group_size
+        self.schema = None
+        self._writer = None
+        self._rows = []
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        if self.schema is None:
+            fields = [pa.field('aoi', STRING)] + [pa.field(name, type) for name, type in self.columns]
+            declared = set(field.name for field in fields)
+            names = sorted(set(key for row in self._rows for key in row) - declared)
+            fields += [pa.field(name, get_type([row.get(name) for row in self._rows])) for name in names]
+            self.schema = pa.schema(fields)
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        extra = set(key for row in self._rows for key in row) - set(self.schema.names)
+        if extra:
+            raise ValueError('{}: columns not in schema: {}'.format(self.path, ', '.join(sorted(extra))))
+        arrays = [to_array([row.get(field.name) for row in self._rows], field.type)
+                  for field in self.schema]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def abort(self):
+        # Close and remove a partly written file
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def export(queue, output, row_group_size=ROW_GROUP_SIZE):
+    # Write the completed jobs of a job queue to <family>.parquet files in
+    # output
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    kinds = scan_columns(queue.iter_results())
+    writers = {}
+    try:
+        for family, name, result in queue.iter_results():
+            if family not in writers:
+                writers[family] = ColumnarWriter(os.path.join(output, family + '.parquet'),
+                                                 get_columns(family, kinds[family]), row_group_size)
+            for row in get_rows(family, name, json.loads(result)):
+                writers[family].write(row)
+        for writer in writers.values():
+            writer.close()
+    except Exception:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write batch results from a job queue to Parquet.')
+    parser.add_argument('queue', help='path to the SQLite job queue')
+    parser.add_argument('output', help='directory to write <family>.parquet files to')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE,
+                        help='number of rows per Parquet row group')
+    args = parser.parse_args()
+
+    export(JobQueue(args.queue), args.output, args.row_group_size)
@@ -1,8 +1,37 @@
+import os
 import re
+import json
 import threading
+import traceback
 
 import ee
 
+from results import ResultStore, BACKGROUND
+
+# Set DT_TRANSFER_STATS to record in the result store statistics the number of
+# bytes of feature properties downloaded and the number of bytes of geometry
+# that were dropped server-side instead. Measuring the geometry size costs an
+# extra server-side computation, so this is off by default.
+TRANSFER_STATS = bool(os.environ.get('DT_TRANSFER_STATS'))
+
+# Function to download the features in a feature class with their properties 
+# only, as only the properties are used and the geometries (AOIs, species 
+# ranges) can be megabytes. If filter_regex is given, only properties 
+# matching it are selected.
+def get_fc_info(fc, filter_regex=None):
+    selector = filter_regex + '.*' if filter_regex else '.*'
+    properties = fc.select([selector], None, False)
+    if not TRANSFER_STATS:
+        return properties.getInfo()
+    geometry_bytes = fc.map(lambda f: f.set('geometry_bytes', ee.String.encodeJSON(f.geometry()).length())) \
+            .aggregate_sum('geometry_bytes')
+    info = ee.Dictionary({'fc': properties, 'geometry_bytes': geometry_bytes}).getInfo()
+    store = ResultStore()
+    store.incr('transfer', 'property_bytes', len(json.dumps(info['fc'])))
+    store.incr('transfer', 'geometry_bytes_saved', int(info['geometry_bytes']))
+    return info['fc']
+
+
 # Function to pull areas that are saved as properties within a feature class,
 # convert them to percentages of the total area, and return as a dictionary. Sums
 # all features together. Scaling converts to percentages if set to 100 and
@@ -12,7 +41,7 @@ def get_fc_properties(fc, normalize=False, scaling=None, filter_regex=None):
         regex = re.compile(filter_regex)
     # Note that there may be multiple features
     ret = {}
-    for p in [feature['properties'] for feature in fc.getInfo()['features']]:
+    for p in [feature.get('properties', {}) for feature in get_fc_info(fc, filter_regex)['features']]:
         # If there is more than one feature, need to update ret with these 
         # values
         for key, value in p.iteritems():
@@ -23,6 +52,12 @@ def get_fc_properties(fc, normalize=False, scaling=None, filter_regex=None):
                 ret[key] += value
             else:
                 ret[key] = value
+    return normalize_values(ret, normalize, scaling)
+
+
+# Normalize the values of a dictionary so they sum to one if normalize is True,
+# and multiply them by scaling if it is set
+def normalize_values(ret, normalize=False, scaling=None):
     if normalize:
         denominator = sum(ret.values())
         if denominator == 0:
@@ -36,20 +71,121 @@ def get_fc_properties(fc, normalize=False, scaling=None, filter_regex=None):
     return ret
 
 
+# Function to compute the area in hectares of each class of a single band image 
+# within a region, using one grouped sum of pixel areas rather than one band 
+# per class. Returns a dictionary mapping each class present in the region to 
+# its area. If second is given, computes a contingency table of the two images 
+# instead, keyed by (class, second class) tuples. Pixels where second is masked 
+# are counted under second class NODATA, so that summing over the second 
+# classes gives the same areas as image alone. Reductions are done in the 
+# projection of image, at its native scale unless scale is given.
+NODATA = -32768
+
+def get_class_areas(image, aoi, second=None, scale=None, MAX_PIXELS=1e13):
+    if second is None:
+        stack = ee.Image.pixelArea().divide(10000).addBands(image)
+        reducer = ee.Reducer.sum().group(groupField=1, groupName='class')
+    else:
+        stack = ee.Image.pixelArea().divide(10000).addBands(second.unmask(NODATA)).addBands(image)
+        reducer = ee.Reducer.sum().group(groupField=1, groupName='second') \
+                .group(groupField=2, groupName='class')
+    groups = stack.reduceRegion(reducer=reducer, geometry=aoi, scale=scale, 
+                                crs=image.projection(), maxPixels=MAX_PIXELS) \
+            .getInfo()['groups']
+    ret = {}
+    for g in groups:
+        if second is None:
+            ret[int(g['class'])] = g['sum']
+        else:
+            for h in g['groups']:
+                ret[(int(g['class']), int(h['second']))] = h['sum']
+    return ret
+
+
+# Convert a dictionary of class areas from get_class_areas to a dictionary keyed 
+# by field name, with zero for classes not present in the region, then 
+# normalize and scale it as for get_fc_properties
+def class_areas_to_fields(areas, classes, fields, normalize=False, scaling=None):
+    ret = {field: areas.get(c, 0.) for c, field in zip(classes, fields)}
+    return normalize_values(ret, normalize, scaling)
+
+
 def get_fc_properties_text(fc, filter_regex=None):
+    return list(iter_fc_properties(fc, filter_regex))
+
+
+# Number of features per page, and number of pages downloaded at once, for 
+# iter_fc_properties
+PAGE_SIZE = 500
+PAGE_CONCURRENCY = 4
+
+# Generator yielding the properties of each feature in a feature class, in 
+# order. Features are downloaded in pages of page_size. The first page is 
+# fetched on its own, so a collection that fits in one page is evaluated once. 
+# Otherwise the features are counted, and the remaining pages are downloaded 
+# with up to concurrency pages in flight, so that results beyond the Earth 
+# Engine element limits can be retrieved and memory use does not grow with the 
+# size of the result.
+def iter_fc_properties(fc, filter_regex=None, page_size=PAGE_SIZE, 
+                       concurrency=PAGE_CONCURRENCY):
     if filter_regex:
         regex = re.compile(filter_regex)
-    # Note that there may be multiple features
-    ret = []
-    for p in [feature['properties'] for feature in fc.getInfo()['features']]:
-        this_ret = {}
-        for key, value in p.iteritems():
+    pages = {}
+    def get_page(offset):
+        page = ee.FeatureCollection(fc.toList(page_size, offset))
+        pages[offset] = get_fc_info(page, filter_regex)['features']
+    in_flight = [(0, GEECall(get_page, 0))]
+    offsets = None
+    while in_flight:
+        offset, thread = in_flight.pop(0)
+        thread.join()
+        features = pages.pop(offset)
+        if offsets is None:
+            # Only count the features if they don't fit in the first page, 
+            # so that no page is requested past the end of the collection
+            size = fc.size().getInfo() if len(features) == page_size else 0
+            offsets = iter(range(page_size, size, page_size))
+        # Start on the next pages before handing out the rows of this one
+        while len(in_flight) < concurrency:
+            next_offset = next(offsets, None)
+            if next_offset is None:
+                break
+            in_flight.append((next_offset, GEECall(get_page, next_offset)))
+        for feature in features:
+            p = feature.get('properties', {})
             if filter_regex:
-                if not regex.match(key):
-                    continue
-            this_ret[key] = value
-        ret.append(this_ret)
-    return ret
+                p = {key: value for key, value in p.items() if regex.match(key)}
+            yield p
+
+
+# Scale in meters to run all reductions at when it is coarser than the scale a
+# metric would normally use. Set through DT_SCALE for the preview pass of
+# progressive.py.
+SCALE_OVERRIDE = float(os.environ['DT_SCALE']) if os.environ.get('DT_SCALE') else None
+
+def get_scale(scale=None):
+    if SCALE_OVERRIDE is not None and (scale is None or SCALE_OVERRIDE > scale):
+        return SCALE_OVERRIDE
+    return scale
+
+
+SERVICE_ACCOUNT = 'gef-ldmp-server@gef-ld-toolbox.iam.gserviceaccount.com'
+
+_initialized = False
+
+# Initialize Earth Engine with the service account key in DT_KEY_FILE (by 
+# default dt_key.json). Only the first call in a process does anything, so 
+# worker processes keep one session across the scripts they run.
+def initialize():
+    global _initialized
+    if _initialized:
+        return
+    key_file = os.environ.get('DT_KEY_FILE', 'dt_key.json')
+    with open(key_file) as f:
+        service_account = json.load(f).get('client_email', SERVICE_ACCOUNT)
+    credentials = ee.ServiceAccountCredentials(service_account, key_file)
+    ee.Initialize(credentials)
+    _initialized = True
 
 
 def get_coords(geojson):
@@ -61,23 +197,65 @@ def get_coords(geojson):
     else:
         return geojson.get('coordinates')
 
+# Background jobs (DT_PRIORITY=background) wait before each query while an 
+# interactive request is being computed. Queries already sent to Earth Engine 
+# still run to completion.
+def wait_for_interactive():
+    if os.environ.get('DT_PRIORITY') == BACKGROUND:
+        ResultStore().wait_until_idle()
+
+# Function called when a query made through GEECall starts or finishes. Worker 
+# processes set it to tell a job that is making progress from a stuck one.
+on_progress = None
+
+def report_progress():
+    if on_progress is not None:
+        on_progress()
+
 class GEEThread(threading.Thread):
     def __init__(self, target, *args):
+        threading.Thread.__init__(self)
         self._target = target
         self._args = args
-        threading.Thread.__init__(self)
+        self.error = None
 
     def run(self):
-        self._target(*self._args)
+        try:
+            wait_for_interactive()
+            report_progress()
+            self._target(*self._args)
+            report_progress()
+        except Exception as e:
+            # Keep the error so that it is raised again by join(), rather than 
+            # leaving the output of the thread silently missing
+            traceback.print_exc()
+            self.error = e
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error is not None:
+            raise self.error
 
 def GEECall(target, *args):
     thread = GEEThread(target, *args)
     thread.start()
     return thread
 
+# Wait for all of the threads to finish, then raise the first error any of 
+# them hit, so that incomplete results are never published
+def join_all(threads):
+    for t in threads:
+        threading.Thread.join(t)
+    for t in threads:
+        t.join()
+
 
 ###############################################################################
 # Commonly used functions
+#
+# Functions taking raw=True write raw values that can be summed over disjoint 
+# regions (hectares rather than percentages, and area-weighted sums and areas 
+# rather than means) - see get_mean and region_metrics.py.
 def get_area(out, aoi):
     # polygon area in hectares
     out['area_hectares'] = aoi.area().divide(10000).getInfo()
@@ -86,16 +264,17 @@ def get_pop(out, aoi, MAX_PIXELS=1e9):
     # s2_02: Number of people living inside the polygon in 2015
     pop_cnt = ee.Image("CIESIN/GPWv4/unwpp-adjusted-population-count/2015")
     population = pop_cnt.reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, 
-                                      scale=1000, maxPixels=MAX_PIXELS, bestEffort=True)
+                                      scale=get_scale(1000), maxPixels=MAX_PIXELS, bestEffort=True)
     out['population'] = population.getInfo()['population-count']
 
-def get_area_sdg(out, aoi):
+def get_area_sdg(out, aoi, raw=False):
     # s3_01: SDG 15.3.1 degradation classes 
     te_sdgi = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_sdg1531_gpg_globe_2001_2015_modis")
-    sdg_areas = te_sdgi.eq([-32768,-1,0,1]).rename(["nodata", "degraded", "stable", "improved"]).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['area_sdg'] = get_fc_properties(sdg_areas, normalize=True, scaling=100)
+    sdg_areas = get_class_areas(te_sdgi, aoi, scale=get_scale())
+    out['area_sdg'] = class_areas_to_fields(sdg_areas, [-32768,-1,0,1], ["nodata", "degraded", "stable", "improved"], 
+                                            normalize=not raw, scaling=None if raw else 100)
 
-def get_ecosystem_service_dominant(out, aoi):
+def get_ecosystem_service_dominant(out, aoi, raw=False):
     # dominant ecosystem service
     dom_service = ee.Image("users/geflanddegradation/toolbox_datasets/ecoserv_greatesttotalrealisedservice")
 
@@ -103,19 +282,35 @@ def get_ecosystem_service_dominant(out, aoi):
     es_fields = ["none","carbon", "nature-basedtourism", "culture-basedtourism", "water", "hazardmitigation", "commercialtimber", "domestictimber", "commercialfisheries",
                   "artisanalfisheries", "fuelwood", "grazing", "non-woodforestproducts", "wildlifedis-services", "wildlifeservices", "environmentalquality"]
 
-    # multiply pixel area by the area which experienced each of the three transitions --> output: area in ha
-    dom_serv_area = dom_service.eq([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15]).rename(es_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
+    # area in ha of each of the dominant ecosystem services in the area
+    dom_serv_area = get_class_areas(dom_service, aoi, scale=get_scale())
 
     # table with areas of each of the dominant ecosystem services in the area
-    out['ecosystem_service_dominant'] = get_fc_properties(dom_serv_area, normalize=True, scaling=100)
+    out['ecosystem_service_dominant'] = class_areas_to_fields(dom_serv_area, range(16), es_fields, 
+                                                              normalize=not raw, scaling=None if raw else 100)
 
-def get_ecosystem_service_value(out, aoi, MAX_PIXELS=1e9):
+def get_ecosystem_service_value(out, aoi, MAX_PIXELS=1e9, raw=False):
     # Relative realised service index (0-1)
     eco_serv_index = ee.Image("users/geflanddegradation/toolbox_datasets/ecoserv_total_real_services")
 
     # compute statistics for the region
-    eco_s_index_mean = eco_serv_index.reduceRegion(reducer=ee.Reducer.mean(),
-                                                       geometry=aoi, scale=10000, 
-                                                       maxPixels=MAX_PIXELS, bestEffort=True)
+    eco_s_index_mean = get_area_weighted_sum(eco_serv_index, aoi, get_scale(10000), MAX_PIXELS)
     # mean ecosystem service relative index for the region
-    out['ecosystem_service_value'] = eco_s_index_mean.getInfo()['b1']
+    out['ecosystem_service_value'] = eco_s_index_mean if raw else get_mean(eco_s_index_mean)
+
+# Sum of the values of a single band image over a region weighted by pixel 
+# area, and the area of the pixels with values, both in hectares. Unlike pixel 
+# counts, these don't depend on the scale the reduction ran at, so they can be 
+# summed over regions computed at different scales.
+def get_area_weighted_sum(image, aoi, scale, MAX_PIXELS=1e9):
+    area = ee.Image.pixelArea().divide(10000)
+    stack = image.multiply(area).rename('sum').addBands(area.updateMask(image.mask()).rename('area'))
+    ret = stack.reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, scale=scale, 
+                             maxPixels=MAX_PIXELS, bestEffort=True).getInfo()
+    return {'sum': ret['sum'] or 0, 'area': ret['area'] or 0}
+
+# Mean from an area-weighted sum, or None if no pixels had values
+def get_mean(raw):
+    if not raw['area']:
+        return None
+    return raw['sum'] / raw['area']
@@ -0,0 +1,113 @@
+# Prepared raster versions of the vector layers used by the metric scripts.
+#
+# The key biodiversity area, protected area and livelihood zone layers are
+# global FeatureCollections, and rasterizing them with reduceToImage on every
+# request is one of the most expensive server-side steps. Running this module as
+# a script exports pre-rasterized versions of them at working resolution to
+# Earth Engine assets, and records the finished assets in a local registry
+# (prepared_layers.json, or the file named by DT_PREPARED_LAYERS). get_layer()
+# uses a registered raster when its resolution is fine enough for the request,
+# and otherwise rasterizes the vectors after filtering them to the AOI bounds.
+#
+#  Takes the asset folder to export to, and optionally the names of the layers
+# to prepare:
+#
+#     python layers.py users/geflanddegradation/toolbox_datasets kba pas
+
+import os
+import sys
+import json
+import time
+
+import ee
+
+from common import initialize
+from results import REGISTRY_PATH, write_atomic, read_registry
+
+# presence layers are 1 inside a feature and 0 elsewhere, other layers hold the
+# value of the property (0 where there is no feature)
+LAYERS = {
+    'kba': {'collection': 'users/geflanddegradation/toolbox_datasets/KBAsGlobal_2018_01',
+            'property': 'OBJECTID', 'presence': True, 'scale': 300},
+    'pas': {'collection': 'WCMC/WDPA/current/polygons',
+            'property': 'METADATAID', 'presence': True, 'scale': 300},
+    'livelihoods': {'collection': 'users/geflanddegradation/toolbox_datasets/livelihoodzones',
+                    'property': 'lztype_num', 'presence': False, 'scale': 250}
+}
+
+_registry = None
+_registry_mtime = None
+
+
+def load_registry():
+    # The registry is read again when the file changes, so that long-running
+    # worker processes pick up layers registered after they started
+    global _registry, _registry_mtime
+    try:
+        mtime = os.path.getmtime(REGISTRY_PATH)
+    except OSError:
+        mtime = None
+    if _registry is None or mtime != _registry_mtime:
+        _registry = read_registry()
+        _registry_mtime = mtime
+    return _registry
+
+
+def rasterize(name, fc):
+    layer = LAYERS[name]
+    if layer['presence']:
+        image = fc.reduceToImage(properties=[layer['property']], reducer=ee.Reducer.first()).gte(0)
+    else:
+        image = fc.filter(ee.Filter.neq(layer['property'], None)) \
+                .reduceToImage(properties=[layer['property']], reducer=ee.Reducer.first())
+    return image.unmask(0)
+
+
+def get_layer(name, aoi, scale=None):
+    # Returns the named layer as an image for use within aoi at the given scale
+    layer = LAYERS[name]
+    prepared = load_registry().get(name)
+    if prepared and prepared['source'] == layer['collection'] \
+            and scale is not None and scale >= prepared['scale']:
+        return ee.Image(prepared['asset'])
+    return rasterize(name, ee.FeatureCollection(layer['collection']).filterBounds(aoi))
+
+
+def prepare_layers(folder, names):
+    tasks = {}
+    for name in names:
+        layer = LAYERS[name]
+        asset = '{}/{}_prepared_{}m'.format(folder, name, layer['scale'])
+        image = rasterize(name, ee.FeatureCollection(layer['collection'])).byte()
+        task = ee.batch.Export.image.toAsset(image=image, description='prepare_{}'.format(name),
+                                             assetId=asset, crs='EPSG:4326', scale=layer['scale'],
+                                             region=ee.Geometry.Rectangle([-180, -90, 180, 90], None, False),
+                                             maxPixels=1e13)
+        task.start()
+        tasks[name] = (task, asset)
+
+    # Only register layers once their export has finished
+    registry = load_registry()
+    while tasks:
+        time.sleep(60)
+        for name, (task, asset) in list(tasks.items()):
+            state = task.status()['state']
+            if state == 'COMPLETED':
+                registry[name] = {'asset': asset,
+                                  'scale': LAYERS[name]['scale'],
+                                  'source': LAYERS[name]['collection']}
+                write_atomic(REGISTRY_PATH, json.dumps(registry, indent=4, sort_keys=True))
+            elif state in ['FAILED', 'CANCELLED']:
+                sys.stderr.write('export of {} failed: {}\n'.format(name, task.status().get('error_message')))
+            else:
+                continue
+            del tasks[name]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python layers.py ASSET_FOLDER [LAYER ...]')
+
+    initialize()
+
+    prepare_layers(sys.argv[1], sys.argv[2:] or sorted(LAYERS))
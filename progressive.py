@@ -0,0 +1,117 @@
+# Script to run one of the metric scripts in progressive mode, so that
+# approximate numbers can be shown straight away while the full computation
+# runs.
+#
+#  Takes the name of the metric script and a geojson as text as command-line
+# parameters. A preview pass at a coarse scale and the normal pass are started
+# together, and their results are written to standard out as one JSON document
+# per line as they arrive: the preview, flagged with "preview": true, and the
+# final values, with "preview_difference" giving the final minus the preview
+# value for each numeric metric. If the final values arrive first (e.g. when
+# they come from the result store), the preview is dropped.
+#
+#     python progressive.py region_metrics '{"type": "MultiPolygon", ...}'
+
+import os
+import sys
+import json
+import threading
+import subprocess
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from results import HERE
+
+# Scale in meters for the preview pass
+PREVIEW_SCALE = float(os.environ.get('DT_PREVIEW_SCALE', 5000))
+
+
+def start(script, geojson, scale=None):
+    env = dict(os.environ)
+    if scale is not None:
+        env['DT_SCALE'] = str(scale)
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script + '.py'), geojson],
+                            stdout=subprocess.PIPE, env=env)
+
+
+def get_result(process):
+    # Returns the parsed output of a metric script, or None if it failed
+    stdout = process.communicate()[0]
+    if process.returncode != 0:
+        return None
+    try:
+        return json.loads(stdout.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def read_result(name, process, results):
+    results.put((name, get_result(process)))
+
+
+def preview_difference(preview, final):
+    # Difference between the final and preview values, for each numeric value
+    # present in both results
+    if isinstance(final, dict) and isinstance(preview, dict):
+        ret = {}
+        for key, value in final.items():
+            diff = preview_difference(preview.get(key), value)
+            if diff is not None:
+                ret[key] = diff
+        return ret
+    if isinstance(final, list) and isinstance(preview, list) and len(final) == len(preview):
+        return [preview_difference(p, f) for p, f in zip(preview, final)]
+    if isinstance(final, (int, float)) and isinstance(preview, (int, float)) \
+            and not isinstance(final, bool) and not isinstance(preview, bool):
+        return final - preview
+    return None
+
+
+def emit(d):
+    sys.stdout.write(json.dumps(d, ensure_ascii=False, sort_keys=True) + '\n')
+    sys.stdout.flush()
+
+
+def run(script, geojson):
+    # Returns the exit code of the final pass
+    preview_process = start(script, geojson, PREVIEW_SCALE)
+    final_process = start(script, geojson)
+
+    # Read both passes at once, so the final result is emitted as soon as it
+    # arrives and neither process blocks on a full stdout pipe
+    results = Queue()
+    for name, process in [('preview', preview_process), ('final', final_process)]:
+        thread = threading.Thread(target=read_result, args=(name, process, results))
+        thread.daemon = True
+        thread.start()
+
+    preview = None
+    while True:
+        name, result = results.get()
+        if name == 'final':
+            break
+        # A failed preview is not fatal - the final result is still delivered
+        if result is not None:
+            preview = result
+            emit({'preview': True, 'results': preview})
+
+    # The preview is of no use once the final result is in
+    if preview_process.poll() is None:
+        preview_process.kill()
+
+    final = result
+    if final is None:
+        return final_process.returncode or 1
+    out = {'preview': False, 'results': final}
+    if preview is not None:
+        out['preview_difference'] = preview_difference(preview, final)
+    emit(out)
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python progressive.py SCRIPT GEOJSON')
+    sys.exit(run(*sys.argv[1:]))
@@ -10,114 +10,133 @@ import io
 
 import ee
 
-from common import get_fc_properties, get_coords, GEECall, get_area, get_pop, \
-    get_area_sdg, get_ecosystem_service_dominant, get_ecosystem_service_value
-
-service_account = 'gef-ldmp-server@gef-ld-toolbox.iam.gserviceaccount.com'
-credentials = ee.ServiceAccountCredentials(service_account, 'dt_key.json')
-ee.Initialize(credentials)
+from common import get_coords, GEECall, join_all, get_area, get_pop, get_area_sdg, \
+    get_ecosystem_service_dominant, get_ecosystem_service_value, get_scale, \
+    SCALE_OVERRIDE, get_class_areas, class_areas_to_fields, normalize_values, \
+    get_area_weighted_sum, get_mean, initialize
+from results import ResultStore, Flight
+from layers import get_layer
+from spatial import compose, sum_raw
+
+# Class breakdowns that are reported as percentages of the region
+PERCENT_KEYS = ['livelihoods', 'area_sdg', 'area_lc', 'area_soc', 'area_prod', 
+                'prod_forests', 'prod_grasslands', 'prod_agriculture', 'lc_2001', 
+                'lc_2015', 'ecosystem_service_dominant']
+
+# The queries below return raw values that can be summed over disjoint regions 
+# (hectares, and sums and pixel counts for means), so that results can be 
+# composed from regions already in the result store. Convert them to the 
+# values returned by this script.
+def finalize(raw):
+    out = {}
+    for key in ['area_hectares', 'population', 'soc_change_tons_co2e', 'lc_transition_hectares']:
+        if key in raw:
+            out[key] = raw[key]
+    for key in PERCENT_KEYS:
+        if key in raw:
+            out[key] = normalize_values(raw[key], True, 100)
+    if 'livelihoods' in out:
+        # Handle the case of polygons outside of the area of coverage of the 
+        # livelihood zones data
+        if out['livelihoods'].pop('No Data') < 10:
+            # If there is less than 10 percent no data, then ignore the no data 
+            # by eliminating that category, and normalizing all the remaining 
+            # categories to sum to 100
+            out['livelihoods'] = normalize_values(out['livelihoods'], True, 100)
+        else:
+            # if more than 10% of the area is no data, then return zero for all 
+            # categories
+            out['livelihoods'] = {key: 0. for key, value in out['livelihoods'].items()}
+    if 'soc_change_percent' in raw:
+        # Multiply by 100 to convert to a percentage
+        soc_pch = get_mean(raw['soc_change_percent'])
+        out['soc_change_percent'] = soc_pch * 100 if soc_pch is not None else None
+    if 'ecosystem_service_value' in raw:
+        out['ecosystem_service_value'] = get_mean(raw['ecosystem_service_value'])
+    return out
+
+coords = get_coords(json.loads(sys.argv[1]))
+
+# Return the result from the result store if this request has already been
+# computed, or wait for another process that is computing it, rather than
+# running the queries again
+flight = Flight(ResultStore(), 'region_metrics', coords, {'scale': SCALE_OVERRIDE})
+result = flight.join()
+if result is not None:
+    sys.stdout.write(result)
+    sys.exit(0)
+
+# Sum the results of regions already in the result store that tile part of the 
+# AOI, and only compute the part of the AOI they don't cover
+covered_raw, remainder = compose(flight, coords)
+if remainder is None:
+    result = json.dumps(finalize(covered_raw), ensure_ascii=False, indent=4, sort_keys=True)
+    flight.publish(result, covered_raw, coords)
+    sys.stdout.write(result)
+    sys.exit(0)
+
+initialize()
 #ee.Initialize()
 
 MAX_PIXELS= 1e9
 
-aoi = ee.Geometry.MultiPolygon(get_coords(json.loads(sys.argv[1])))
+aoi = ee.Geometry.MultiPolygon(remainder)
 
-out = {}
+raw = {}
 threads = []
 
-threads.append(GEECall(get_area, out, aoi))
-threads.append(GEECall(get_pop, out, aoi))
+threads.append(GEECall(get_area, raw, aoi))
+threads.append(GEECall(get_pop, raw, aoi))
 
 def get_livelihoods(out):
     # s2_03: Main livelihoods
-    liv = ee.FeatureCollection("users/geflanddegradation/toolbox_datasets/livelihoodzones")
-
-    livImage = liv.filter(ee.Filter.neq('lztype_num', None)).reduceToImage(properties=['lztype_num'], reducer=ee.Reducer.first()).unmask(0)
+    livImage = get_layer('livelihoods', aoi, get_scale(250))
 
     liv_fields = ["No Data", "Agro-Forestry", "Agro-Pastoral", "Arid", "Crops - Floodzone", "Crops - Irrigated", "Crops - Rainfed", "Fishery", "Forest-Based", "National Park", "Other", "Pastoral", "Urban"]
-    # multiply pixel area by the area which experienced each of the five transitions --> output: area in ha
-    livelihoodareas = livImage.eq([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]) \
-            .rename(liv_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum(), 250)
-    out['livelihoods'] = get_fc_properties(livelihoodareas, normalize=True, scaling=100)
-    # Handle the case of polygons outside of the area of coverage of the livelihood 
-    # zones data
-    if out['livelihoods']['No Data'] < 10:
-        # If there is less than 10 percent no data, then ignore the no data by 
-        # eliminating that category, and normalizing all the remaining categories 
-        # to sum to 100
-        out['livelihoods'].pop('No Data')
-        denominator = sum(out['livelihoods'].values())
-        out['livelihoods'] = {key: value / denominator * 100 for key, value in out['livelihoods'].iteritems()}
-    else:
-        # if more than 10% of the area is no data, then return zero for all 
-        # categories
-        out['livelihoods'].pop('No Data')
-        out['livelihoods'] = {key: 0. for key, value in out['livelihoods'].iteritems()}
-threads.append(GEECall(get_livelihoods, out))
-
-threads.append(GEECall(get_area_sdg, out, aoi))
+    # area in ha of each of the livelihood zones
+    livelihoodareas = get_class_areas(livImage, aoi, scale=get_scale(250))
+    out['livelihoods'] = class_areas_to_fields(livelihoodareas, range(13), liv_fields)
+threads.append(GEECall(get_livelihoods, raw))
 
-def get_area_prod(out):
-    # s3_02: Productivity degradation classes
-    te_prod = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lp7cl_globe_2001_2015_modis").remap([-32768,1,2,3,4,5,6,7],[-32768,-1,-1,0,0,0,1,1])
-    prod_areas = te_prod.eq([-32768,-1,0,1]).rename(["nodata", "degraded", "stable", "improved"]).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['area_prod'] = get_fc_properties(prod_areas, normalize=True, scaling=100)
-threads.append(GEECall(get_area_prod, out))
+threads.append(GEECall(get_area_sdg, raw, aoi, True))
+
+deg_classes = [-32768, -1, 0, 1]
+prod_fields = ["nodata", "degraded", "stable", "improved"]
+
+te_prod = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lp7cl_globe_2001_2015_modis").remap([-32768,1,2,3,4,5,6,7],[-32768,-1,-1,0,0,0,1,1])
+te_land = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lc_traj_globe_2001-2001_to_2015")
 
 def get_area_lc(out):
     # s3_03: Land cover degradation classes
-    te_land = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lc_traj_globe_2001-2001_to_2015")
-    lc_areas = te_land.select("lc_dg").eq([-32768, -1,0,1]).rename(["nodata", "degraded", "stable", "improved"]).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['area_lc'] = get_fc_properties(lc_areas, normalize=True, scaling=100)
-threads.append(GEECall(get_area_lc, out))
+    lc_areas = get_class_areas(te_land.select("lc_dg"), aoi, scale=get_scale())
+    out['area_lc'] = class_areas_to_fields(lc_areas, deg_classes, prod_fields)
+threads.append(GEECall(get_area_lc, raw))
 
 def get_area_soc(out):
     # s3_04: soc degradation classes
     te_socc_deg = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_soc_globe_2001-2015_deg").select("soc_deg")
-    soc_areas = te_socc_deg.eq([-32768,-1,0,1]).rename(["no data", "degraded", "stable", "improved"]).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['area_soc'] = get_fc_properties(soc_areas, normalize=True, scaling=100)
-threads.append(GEECall(get_area_soc, out))
-
-
-prod_fields = ["nodata", "degraded", "stable", "improved"]
-
-te_land = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lc_traj_globe_2001-2001_to_2015").select("lc_tr")
-te_prod = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lp7cl_globe_2001_2015_modis").remap([-32768,1,2,3,4,5,6,7],[-32768,-1,-1,0,0,0,1,1])
-
-def get_prod_forests(out):
-    prod_forests = te_prod.updateMask(te_land.eq(11)).eq([-32768,-1,0,1]).rename(prod_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['prod_forests'] = get_fc_properties(prod_forests, normalize=True, scaling=100)
-threads.append(GEECall(get_prod_forests, out))
-
-def get_prod_grasslands(out):
-    prod_grasslands = te_prod.updateMask(te_land.eq(22)).eq([-32768,-1,0,1]).rename(prod_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['prod_grasslands'] = get_fc_properties(prod_grasslands, normalize=True, scaling=100)
-threads.append(GEECall(get_prod_grasslands, out))
+    soc_areas = get_class_areas(te_socc_deg, aoi, scale=get_scale())
+    out['area_soc'] = class_areas_to_fields(soc_areas, deg_classes, ["no data", "degraded", "stable", "improved"])
+threads.append(GEECall(get_area_soc, raw))
 
-def get_prod_agriculture(out):
-    prod_agriculture = te_prod.updateMask(te_land.eq(33)).eq([-32768,-1,0,1]).rename(prod_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['prod_agriculture'] = get_fc_properties(prod_agriculture, normalize=True, scaling=100)
-threads.append(GEECall(get_prod_agriculture, out))
+def get_area_prod(out):
+    # s3_02: Productivity degradation classes, overall and within forests, 
+    # grasslands and agriculture that remained stable between 2001 and 2015, 
+    # from a single table of productivity class by land cover transition
+    prod_lc_areas = get_class_areas(te_prod, aoi, second=te_land.select("lc_tr"), scale=get_scale())
+    prod_areas = {}
+    for (prod_class, lc_class), area in prod_lc_areas.items():
+        prod_areas[prod_class] = prod_areas.get(prod_class, 0.) + area
+    out['area_prod'] = class_areas_to_fields(prod_areas, deg_classes, prod_fields)
+    for key, lc_class in [('prod_forests', 11), ('prod_grasslands', 22), ('prod_agriculture', 33)]:
+        out[key] = class_areas_to_fields(prod_lc_areas, [(c, lc_class) for c in deg_classes], prod_fields)
+threads.append(GEECall(get_area_prod, raw))
 
 # s3_06: compute land cover classes for 2001 and 2015, and the transitions which occured
-te_land = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_lc_traj_globe_2001-2001_to_2015")
 
 # field names for annual land covers
 lc_fields = ["forest", "grassland", "agriculture", "wetlands", "artificial", "other land-bare", "water"]
 
-# multiply pixel area by the area which experienced each of the lc classes --> output: area in ha
-lc_baseline = te_land.select("lc_bl").eq([1,2,3,4,5,6,7]).rename(lc_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-# multiply pixel area by the area which experienced each of the lc classes --> output: area in ha
-lc_target = te_land.select("lc_tg").eq([1,2,3,4,5,6,7]).rename(lc_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-
-def get_lc_2001(out):
-    out['lc_2001'] = get_fc_properties(lc_baseline, normalize=True, scaling=100)
-threads.append(GEECall(get_lc_2001, out))
-
-def get_lc_2015(out):
-    out['lc_2015'] = get_fc_properties(lc_target, normalize=True, scaling=100)
-threads.append(GEECall(get_lc_2015, out))
-
 # field names for land cover transitions between 2001-2015
 lc_tr_fields = ["for-for", "for-gra", "for-agr", "for-wet", "for-art", "for-oth", "for-wat",
           "gra-for", "gra-gra", "gra-agr", "gra-wet", "gra-art", "gra-oth", "gra-wat",
@@ -128,23 +147,28 @@ lc_tr_fields = ["for-for", "for-gra", "for-agr", "for-wet", "for-art", "for-oth"
           "wat-for", "wat-gra", "wat-agr", "wat-wet", "wat-art", "wat-oth", "wat-wat"]
 
 def get_lc_transitions(out):
-    # multiply pixel area by the area which experienced each of the lc 
-    # transition classes --> output: area in ha
-    lc_transitions = te_land.select("lc_tr").eq([11,12,13,14,15,16,17,21,22,23,24,25,26,26,31,32,33,34,35,36,37,41,42,43,44,45,46,47,51,52,53,54,55,56,57,
-                  61,62,63,64,65,66,67,71,72,73,74,75,76,77]).rename(lc_tr_fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(aoi, ee.Reducer.sum())
-    out['lc_transition_hectares'] = get_fc_properties(lc_transitions, normalize=False)
-threads.append(GEECall(get_lc_transitions, out))
+    # area in ha of each combination of 2001 and 2015 land cover classes. The 
+    # land cover in each year is the sum over the other year.
+    lc_transitions = get_class_areas(te_land.select("lc_bl"), aoi, second=te_land.select("lc_tg"), scale=get_scale())
+    lc_baseline = {}
+    lc_target = {}
+    for (bl, tg), area in lc_transitions.items():
+        lc_baseline[bl] = lc_baseline.get(bl, 0.) + area
+        lc_target[tg] = lc_target.get(tg, 0.) + area
+    out['lc_2001'] = class_areas_to_fields(lc_baseline, range(1, 8), lc_fields)
+    out['lc_2015'] = class_areas_to_fields(lc_target, range(1, 8), lc_fields)
+    out['lc_transition_hectares'] = class_areas_to_fields(lc_transitions, [(bl, tg) for bl in range(1, 8) for tg in range(1, 8)], 
+                                                          lc_tr_fields)
+threads.append(GEECall(get_lc_transitions, raw))
 
 def get_soc_pch(out):
     # s3_07: percent change in soc stocks between 2001-2015
     soc_pch_img = ee.Image("users/geflanddegradation/global_ld_analysis/r20180821_soc_globe_2001-2015_deg").select("soc_pch")
 
-    # compute statistics for region
-    soc_pch = soc_pch_img.reduceRegion(reducer=ee.Reducer.mean(), geometry=aoi, 
-                                       scale=250, maxPixels=MAX_PIXELS, bestEffort=True)
-    # Multiple by 100 to convert to a percentage
-    out['soc_change_percent'] = soc_pch.getInfo()['soc_pch'] * 100
-threads.append(GEECall(get_soc_pch, out))
+    # compute statistics for region, as an area-weighted sum so that the mean 
+    # can be combined with that of other regions
+    out['soc_change_percent'] = get_area_weighted_sum(soc_pch_img, aoi, get_scale(250), MAX_PIXELS)
+threads.append(GEECall(get_soc_pch, raw))
 
 def get_soc_change_tons_co2e(out):
     # s3_08: change in soc stocks in tons of co2 eq between 2001-2015
@@ -154,15 +178,19 @@ def get_soc_change_tons_co2e(out):
     soc_chg_an = (soc_an_img.select('y2015').subtract(soc_an_img.select('y2001'))).multiply(ee.Image.pixelArea()).divide(10000).multiply(3.67)
     # compute statistics for the region
     soc_chg_tons_co2e = soc_chg_an.reduceRegion(reducer=ee.Reducer.sum(), 
-                                                geometry=aoi, scale=250, 
+                                                geometry=aoi, scale=get_scale(250), 
                                                 maxPixels=MAX_PIXELS, bestEffort=True)
     out['soc_change_tons_co2e'] = soc_chg_tons_co2e.getInfo()['y2015']
-threads.append(GEECall(get_soc_change_tons_co2e, out))
+threads.append(GEECall(get_soc_change_tons_co2e, raw))
 
-threads.append(GEECall(get_ecosystem_service_dominant, out, aoi))
+threads.append(GEECall(get_ecosystem_service_dominant, raw, aoi, True))
 
-threads.append(GEECall(get_ecosystem_service_value, out, aoi))
+threads.append(GEECall(get_ecosystem_service_value, raw, aoi, MAX_PIXELS, True))
 
-for t in threads:
-    t.join()
-sys.stdout.write(json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True))
+join_all(threads)
+# Add the results of the regions covering the rest of the AOI, and store the 
+# raw values for the whole AOI so it can in turn be used to compose others
+raw = sum_raw(raw, covered_raw)
+result = json.dumps(finalize(raw), ensure_ascii=False, indent=4, sort_keys=True)
+flight.publish(result, raw, coords)
+sys.stdout.write(result)
@@ -10,28 +10,64 @@ import io
 
 import ee
 
-from common import get_fc_properties, get_coords, GEECall
+from common import get_fc_properties, get_coords, GEECall, join_all, get_scale, \
+    SCALE_OVERRIDE, initialize
+from results import ResultStore, Flight
+from spatial import compose, sum_raw
+
+# Convert the raw values computed below, which can be summed over disjoint 
+# regions, to the values returned by this script
+def finalize(raw):
+    out = {}
+    for key in ['carbon_emissions_tons_co2e', 'forest_area_hectares_2001', 'forest_area_hectares_2015']:
+        if key in raw:
+            out[key] = raw[key]
+    if 'forest_area_hectares_2001' in raw:
+        out['forest_area_percent_2001'] = raw['forest_area_hectares_2001'] / raw['area_hectares'] * 100
+    if 'forest_area_hectares_2015' in raw:
+        out['forest_area_percents_2015'] = raw['forest_area_hectares_2015'] / raw['area_hectares'] * 100
+    return out
+
+coords = get_coords(json.loads(sys.argv[1]))
 
-service_account = 'gef-ldmp-server@gef-ld-toolbox.iam.gserviceaccount.com'
-credentials = ee.ServiceAccountCredentials(service_account, 'dt_key.json')
-ee.Initialize(credentials)
+# Minimun tree cover to be considered a forest
+tree_cover = 30
+year_start = 2001
+year_end = 2015
 
-aoi = ee.Geometry.MultiPolygon(get_coords(json.loads(sys.argv[1])))
+# Return the result from the result store if this request has already been
+# computed, or wait for another process that is computing it, rather than
+# running the queries again
+flight = Flight(ResultStore(), 'region_metrics_emissions', coords,
+                {'tree_cover': tree_cover, 'year_start': year_start, 'year_end': year_end,
+                 'scale': SCALE_OVERRIDE})
+result = flight.join()
+if result is not None:
+    sys.stdout.write(result)
+    sys.exit(0)
+
+# Sum the results of regions already in the result store that tile part of the 
+# AOI, and only compute the part of the AOI they don't cover
+covered_raw, remainder = compose(flight, coords)
+if remainder is None:
+    result = json.dumps(finalize(covered_raw), ensure_ascii=False, indent=4, sort_keys=True)
+    flight.publish(result, covered_raw, coords)
+    sys.stdout.write(result)
+    sys.exit(0)
+
+initialize()
+
+aoi = ee.Geometry.MultiPolygon(remainder)
+
+raw = {}
+threads = []
 
 # polygon area in hectares
-area_hectares = aoi.area().divide(10000).getInfo()
-
-out = {}
-threads = []
+raw['area_hectares'] = aoi.area().divide(10000).getInfo()
 
 ###############################################################################
 # Carbon emissions calculations
 
-# Minimun tree cover to be considered a forest
-tree_cover = 30
-year_start = 2001
-year_end = 2015
-
 ##############################################/
 # DATASETS
 # Import Hansen global forest dataset
@@ -109,21 +145,23 @@ areas = output.multiply(ee.Image.pixelArea().divide(10000))
 
 def get_carbon_emissions_tons_co2e(out):
     # Get annual emissions and sum them across all years
-    emissions = get_fc_properties(areas.reduceRegions(collection=aoi, reducer=ee.Reducer.sum(), scale=30),
+    emissions = get_fc_properties(areas.reduceRegions(collection=aoi, reducer=ee.Reducer.sum(), scale=get_scale(30)),
             normalize=False, filter_regex='carbon_emissions_tons_co2e_[0-9]*')
     out['carbon_emissions_tons_co2e'] = sum(emissions.values())
-threads.append(GEECall(get_carbon_emissions_tons_co2e, out))
+threads.append(GEECall(get_carbon_emissions_tons_co2e, raw))
 
 def get_forest_areas(out):
-    forest_areas = get_fc_properties(areas.reduceRegions(collection=aoi, reducer=ee.Reducer.sum(), scale=30),
+    forest_areas = get_fc_properties(areas.reduceRegions(collection=aoi, reducer=ee.Reducer.sum(), scale=get_scale(30)),
             normalize=False, filter_regex='forest_cover_[0-9]*')
     out['forest_area_hectares_2001'] = forest_areas['forest_cover_2001']
     out['forest_area_hectares_2015'] = forest_areas['forest_cover_2015']
-    out['forest_area_percent_2001'] = forest_areas['forest_cover_2001'] / area_hectares * 100
-    out['forest_area_percents_2015'] = forest_areas['forest_cover_2015'] / area_hectares * 100
-threads.append(GEECall(get_forest_areas, out))
+threads.append(GEECall(get_forest_areas, raw))
 
-for t in threads:
-    t.join()
+join_all(threads)
+# Add the results of the regions covering the rest of the AOI, and store the 
+# raw values for the whole AOI so it can in turn be used to compose others
+raw = sum_raw(raw, covered_raw)
 # Return all output as json on stdout
-sys.stdout.write(json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True))
+result = json.dumps(finalize(raw), ensure_ascii=False, indent=4, sort_keys=True)
+flight.publish(result, raw, coords)
+sys.stdout.write(result)
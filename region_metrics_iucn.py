@@ -10,14 +10,24 @@ import io
 
 import ee
 
-from common import get_fc_properties, get_fc_properties_text, get_coords, \
-    GEECall
+from common import iter_fc_properties, get_coords, GEECall, join_all, get_scale, \
+    SCALE_OVERRIDE, initialize
+from results import ResultStore, Flight
 
-service_account = 'gef-ldmp-server@gef-ld-toolbox.iam.gserviceaccount.com'
-credentials = ee.ServiceAccountCredentials(service_account, 'dt_key.json')
-ee.Initialize(credentials)
+coords = get_coords(json.loads(sys.argv[1]))
 
-aoi = ee.Geometry.MultiPolygon(get_coords(json.loads(sys.argv[1])))
+# Return the result from the result store if this request has already been
+# computed, or wait for another process that is computing it, rather than
+# running the queries again
+flight = Flight(ResultStore(), 'region_metrics_iucn', coords, {'scale': SCALE_OVERRIDE})
+result = flight.join()
+if result is not None:
+    sys.stdout.write(result)
+    sys.exit(0)
+
+initialize()
+
+aoi = ee.Geometry.MultiPolygon(coords)
 
 out = {}
 
@@ -47,26 +57,7 @@ def f_clip_ranges(feature):
 mammals_clp = mammals_rng_aoi.map(f_clip_ranges)
 
 # multiply pixel area by the area which experienced each of the three transitions --> output: area in ha
-mammals_deg_aoi = te_prod.eq([-32768,-1,0,1]).rename(fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(mammals_clp, ee.Reducer.sum())
-
-###############################################################################
-# Run the two IUCN queries in parallel
-threads = []
-
-# degradation stats per species in range for degradation within aoi
-iucn_deg_aoi = []
-def get_iucn_deg_aoi(iucn_deg_aoi):
-    iucn_deg_aoi.extend(get_fc_properties_text(mammals_deg_aoi))
-threads.append(GEECall(get_iucn_deg_aoi, iucn_deg_aoi))
-
-# degradation stats per species in range for degradation globally
-iucn_deg_all = []
-def get_iucn_deg_all(iucn_deg_all):
-    iucn_deg_all.extend(get_fc_properties_text(mammals_deg_all))
-threads.append(GEECall(get_iucn_deg_all, iucn_deg_all))
-
-for t in threads:
-    t.join()
+mammals_deg_aoi = te_prod.eq([-32768,-1,0,1]).rename(fields).multiply(ee.Image.pixelArea().divide(10000)).reduceRegions(mammals_clp, ee.Reducer.sum(), get_scale())
 
 ###############################################################################
 # Clean up the returned IUCN results
@@ -87,17 +78,40 @@ def clean_iucn_degradation(d):
                         'stable': stable / total * 100,
                         'improved': improved / total * 100}
     return d
-iucn_deg_aoi  = [clean_iucn_degradation(i) for i in iucn_deg_aoi]
-iucn_deg_all = [clean_iucn_degradation(i) for i in iucn_deg_all]
+
+###############################################################################
+# Run the two IUCN queries in parallel. Results are downloaded page by page and 
+# cleaned up as they arrive, so species-rich AOIs don't hit the Earth Engine 
+# element limits.
+threads = []
+
+# degradation stats per species in range for degradation within aoi
+iucn_deg_aoi = []
+def get_iucn_deg_aoi(iucn_deg_aoi):
+    for d in iter_fc_properties(mammals_deg_aoi):
+        iucn_deg_aoi.append(clean_iucn_degradation(d))
+threads.append(GEECall(get_iucn_deg_aoi, iucn_deg_aoi))
+
+# degradation stats per species in range for degradation globally - only the 
+# degradation is needed from these, keyed by species
+iucn_deg_all = {}
+def get_iucn_deg_all(iucn_deg_all):
+    for d in iter_fc_properties(mammals_deg_all):
+        d = clean_iucn_degradation(d)
+        iucn_deg_all[d['binomial']] = d['degradation']
+threads.append(GEECall(get_iucn_deg_all, iucn_deg_all))
+
+join_all(threads)
 
 # Now combine the two lists together so each species has a percent area 
 # degraded in its range, and a percent area degraded in the aoi
 iucn_deg = iucn_deg_aoi
 for item in iucn_deg:
-    entire_range = [s for s in iucn_deg_all if s['binomial'] == item['binomial']][0]
     item['degradation'] = {'aoi': item['degradation'],
-                           'entire range': entire_range['degradation']}
+                           'entire range': iucn_deg_all[item['binomial']]}
 out['iucn_mammals'] = iucn_deg
 
 # Return all output as json on stdout
-sys.stdout.write(json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True))
+result = json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True)
+flight.publish(result)
+sys.stdout.write(result)
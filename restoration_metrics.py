@@ -10,14 +10,29 @@ import io
 
 import ee
 
-from common import get_fc_properties, get_coords, GEECall, get_pop, \
-    get_area_sdg, get_ecosystem_service_dominant, get_ecosystem_service_value
+from common import get_fc_properties, get_coords, GEECall, join_all, get_pop, \
+    get_area_sdg, get_ecosystem_service_dominant, get_ecosystem_service_value, \
+    get_scale, SCALE_OVERRIDE, initialize
+from results import ResultStore, Flight
+from layers import get_layer
 
-service_account = 'gef-ldmp-server@gef-ld-toolbox.iam.gserviceaccount.com'
-credentials = ee.ServiceAccountCredentials(service_account, 'dt_key.json')
-ee.Initialize(credentials)
+coords = get_coords(json.loads(sys.argv[1]))
 
-aoi = ee.Geometry.MultiPolygon(get_coords(json.loads(sys.argv[1])))
+co2_dollar_per_ton = 50
+
+# Return the result from the result store if this request has already been
+# computed, or wait for another process that is computing it, rather than
+# running the queries again
+flight = Flight(ResultStore(), 'restoration_metrics', coords,
+                {'co2_dollar_per_ton': co2_dollar_per_ton, 'scale': SCALE_OVERRIDE})
+result = flight.join()
+if result is not None:
+    sys.stdout.write(result)
+    sys.exit(0)
+
+initialize()
+
+aoi = ee.Geometry.MultiPolygon(coords)
 
 out = {}
 out['interventions'] = {'forest restoration': {},
@@ -27,8 +42,6 @@ out['interventions'] = {'forest restoration': {},
 
 threads = []
 
-co2_dollar_per_ton = 50
-
 ###############################################################################
 # General statistics on polygon
 
@@ -42,6 +55,7 @@ if aoi_area < 5000:
     scale = 20
 else:
     scale = 300
+scale = get_scale(scale)
 MAX_PIXELS= 1e9
 
 # Need the population value, so need to wait on this thread
@@ -151,17 +165,9 @@ pot_forest = pot_vegeta.remap([1, 2, 3, 4, 7, 8, 9, 13, 14, 15, 16, 17, 18, 19,
 # 31	low and high shrub tundra
 # 32	prostrate dwarf-shrub tundra
 
-# key biodiversity area
-kbas = ee.FeatureCollection("users/geflanddegradation/toolbox_datasets/KBAsGlobal_2018_01")
-
-# convert to raster
-kba_r = kbas.reduceToImage(properties=['OBJECTID'], reducer=ee.Reducer.first()).gte(0)
-
-# protected areas
-pas = ee.FeatureCollection("WCMC/WDPA/current/polygons")
-
-# convert to raster
-pas_r = pas.reduceToImage(properties=['METADATAID'], reducer=ee.Reducer.first()).gte(0)
+# key biodiversity areas and protected areas as rasters (1 inside, 0 outside)
+kba_r = get_layer('kba', aoi, scale)
+pas_r = get_layer('pas', aoi, scale)
 
 #Import SOC (ton/Ha)
 soc = ee.Image("users/geflanddegradation/toolbox_datasets/soc_sgrid_30cm_unccd_20180111")
@@ -372,6 +378,7 @@ threads.append(GEECall(get_ecosystem_service_dominant, out, aoi))
 
 threads.append(GEECall(get_ecosystem_service_value, out, aoi))
 
-for t in threads:
-    t.join()
-sys.stdout.write(json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True))
+join_all(threads)
+result = json.dumps(out, ensure_ascii=False, indent=4, sort_keys=True)
+flight.publish(result)
+sys.stdout.write(result)
@@ -0,0 +1,391 @@
+# Result store shared by the Decision Theater scripts.
+#
+# Results are kept as JSON text in a directory on disk, keyed by a hash of the
+# metric family (the script that computed them), its parameters and the
+# normalized AOI. The store is also used to coalesce concurrent identical
+# requests: the first process to ask for a key computes it while holding a
+# lock on that key, and any process asking for the same key in the meantime
+# waits on the lock and returns the same result instead of issuing its own set
+# of Earth Engine calls.
+#
+# Keys include a fingerprint of the Earth Engine asset IDs used by the family,
+# including the prepared layer rasters registered for it (see layers.py), so
+# results are recomputed when a dataset is swapped for a new version, and a
+# hash of the source of the family script and the shared modules it uses, so
+# results are recomputed when the computation changes.
+#
+# Families whose outputs can be summed over disjoint regions also store their
+# raw additive values, and the AOI is added to a per-variant index (a variant
+# being a family with given parameters and datasets), so that results for new
+# AOIs can be composed from stored ones (see spatial.py). The spatial index
+# keeps the bounding boxes of the AOIs in an SQLite R*Tree (index.db), and the
+# geometry of each AOI in its own file, so finding candidate AOIs doesn't grow
+# linearly with the number stored and only the geometries of candidates are
+# read.
+#
+#  Run as a script to print the store statistics as JSON:
+#
+#     python results.py stats
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import fcntl
+import sqlite3
+import hashlib
+from contextlib import contextmanager, closing
+
+DEFAULT_PATH = os.environ.get('DT_RESULT_STORE', 'result_store')
+
+# Requests started by the theater are interactive. Background jobs such as the
+# cache warm-up set DT_PRIORITY=background so that they pause between queries
+# while interactive ones are being computed (see common.wait_for_interactive).
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Registry of prepared layer rasters, written by layers.py
+REGISTRY_PATH = os.environ.get('DT_PREPARED_LAYERS',
+                               os.path.join(HERE, 'prepared_layers.json'))
+
+ASSET_RE = re.compile(r'(?:ee\.(?:Image|ImageCollection|FeatureCollection)\(\s*|\'collection\':\s*)[\'"]([^\'"]+)[\'"]')
+LAYER_RE = re.compile(r'get_layer\(\s*[\'"]([^\'"]+)[\'"]')
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS aois (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    variant TEXT NOT NULL,
+    key TEXT NOT NULL,
+    UNIQUE (variant, key)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS aoi_bboxes USING rtree(id, min_x, max_x, min_y, max_y);
+"""
+
+# The R*Tree stores coordinates as 32-bit floats rounded outwards, so bounding
+# box queries are widened by this many degrees (about 10 m)
+RTREE_SLACK = 1e-4
+
+# Coordinates are rounded to this many decimal places (about 1 cm at the
+# equator) before hashing, so that the same polygon sent from different
+# screens maps to the same key
+COORD_PRECISION = 7
+
+
+def normalize_coords(coords):
+    if isinstance(coords, (list, tuple)):
+        return [normalize_coords(c) for c in coords]
+    return round(float(coords), COORD_PRECISION)
+
+
+def read_registry():
+    try:
+        with open(REGISTRY_PATH) as f:
+            return json.load(f)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return {}
+        raise
+
+
+def dataset_version(family):
+    # Fingerprint of the asset IDs referenced by a family's script and by the
+    # shared functions and layers it uses, and of the prepared rasters
+    # registered for those layers
+    ids = set()
+    layers = set()
+    for name in [family + '.py', 'common.py', 'layers.py']:
+        with open(os.path.join(HERE, name)) as f:
+            text = f.read()
+        ids.update(ASSET_RE.findall(text))
+        if name == family + '.py':
+            layers.update(LAYER_RE.findall(text))
+    registry = read_registry()
+    for name in layers:
+        if name in registry:
+            ids.add('{}@{}'.format(registry[name]['asset'], registry[name]['scale']))
+    return hashlib.sha1(json.dumps(sorted(ids)).encode('utf-8')).hexdigest()[:12]
+
+
+def code_version(family):
+    # Hash of the source of a family's script and of the shared functions and
+    # layers it uses. Any edit to them, including to comments, gives new keys.
+    h = hashlib.sha1()
+    for name in [family + '.py', 'common.py', 'layers.py']:
+        with open(os.path.join(HERE, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def make_variant(family, params=None):
+    payload = json.dumps({'family': family,
+                          'datasets': dataset_version(family),
+                          'code': code_version(family),
+                          'params': params or {}}, sort_keys=True)
+    return '{}-{}'.format(family, hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12])
+
+
+def make_key(family, coords, params=None):
+    aoi = json.dumps(normalize_coords(coords))
+    return '{}-{}'.format(make_variant(family, params), hashlib.sha1(aoi.encode('utf-8')).hexdigest())
+
+
+def bounding_box(coords):
+    # [min x, min y, max x, max y] of GeoJSON coordinates of any depth
+    if isinstance(coords[0], (list, tuple)):
+        boxes = [bounding_box(c) for c in coords]
+        return [min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes)]
+    return [coords[0], coords[1], coords[0], coords[1]]
+
+
+def write_atomic(path, text):
+    # Write to a temporary file and rename it so readers never see a partial
+    # result
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+
+@contextmanager
+def _flocked(path, mode=fcntl.LOCK_EX):
+    with open(path, 'a+') as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ResultStore(object):
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        for d in ['results', 'locks', 'raw', 'index']:
+            try:
+                os.makedirs(os.path.join(path, d))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def result_path(self, key):
+        return os.path.join(self.path, 'results', key + '.json')
+
+    def lock_path(self, key):
+        return os.path.join(self.path, 'locks', key + '.lock')
+
+    def get(self, key, since=None):
+        # Returns the stored result text for key, or None if there is none. If
+        # since is given, only return a result written at or after that time.
+        path = self.result_path(key)
+        try:
+            if since is not None and os.path.getmtime(path) < since:
+                return None
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def put(self, key, text, raw=None, variant=None, coords=None):
+        # If raw is given, the raw additive values are stored too and coords is
+        # added to the index for variant
+        if raw is not None:
+            write_atomic(os.path.join(self.path, 'raw', key + '.json'), json.dumps(raw))
+            index_path = os.path.join(self.path, 'index', variant)
+            try:
+                os.makedirs(index_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            coords = normalize_coords(coords)
+            write_atomic(os.path.join(index_path, key + '.json'), json.dumps(coords))
+            box = bounding_box(coords)
+            with closing(self._index()) as db:
+                with db:
+                    cursor = db.execute('INSERT OR IGNORE INTO aois (variant, key) VALUES (?, ?)',
+                                        (variant, key))
+                    if cursor.rowcount:
+                        db.execute('INSERT INTO aoi_bboxes VALUES (?, ?, ?, ?, ?)',
+                                   (cursor.lastrowid, box[0], box[2], box[1], box[3]))
+        write_atomic(self.result_path(key), text)
+
+    def _index(self):
+        db = sqlite3.connect(os.path.join(self.path, 'index.db'), timeout=60)
+        db.executescript(INDEX_SCHEMA)
+        return db
+
+    def get_raw(self, key):
+        with open(os.path.join(self.path, 'raw', key + '.json')) as f:
+            return json.load(f)
+
+    def index_candidates(self, variant, box, margin=0):
+        # Keys of the AOIs indexed for variant whose bounding box lies within
+        # box ([min x, min y, max x, max y]) grown by margin
+        margin += RTREE_SLACK
+        with closing(self._index()) as db:
+            rows = db.execute('SELECT aois.key FROM aoi_bboxes JOIN aois ON aois.id = aoi_bboxes.id '
+                              'WHERE aois.variant = ? AND min_x >= ? AND max_x <= ? '
+                              'AND min_y >= ? AND max_y <= ?',
+                              (variant, box[0] - margin, box[2] + margin,
+                               box[1] - margin, box[3] + margin)).fetchall()
+        return [row[0] for row in rows]
+
+    def index_coords(self, variant, key):
+        with open(os.path.join(self.path, 'index', variant, key + '.json')) as f:
+            return json.load(f)
+
+    def mark_live(self):
+        # Hold a shared lock on live.lock for as long as the returned file is
+        # open, to signal that an interactive request is being computed
+        f = open(os.path.join(self.path, 'live.lock'), 'a+')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+
+    def is_idle(self):
+        # True if no interactive request is being computed
+        with open(os.path.join(self.path, 'live.lock'), 'a+') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return True
+
+    def wait_until_idle(self):
+        # Block until no interactive request is being computed
+        with _flocked(os.path.join(self.path, 'live.lock')):
+            pass
+
+    def incr(self, family, counter, n=1):
+        with _flocked(os.path.join(self.path, 'stats.lock')):
+            stats = self._read_stats()
+            counters = stats.setdefault(family, {})
+            counters[counter] = counters.get(counter, 0) + n
+            write_atomic(os.path.join(self.path, 'stats.json'),
+                          json.dumps(stats, indent=4, sort_keys=True))
+
+    def _read_stats(self):
+        try:
+            with open(os.path.join(self.path, 'stats.json')) as f:
+                return json.load(f)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+
+    def stats(self):
+        # Counters per metric family, with the share of requests served from
+        # the store and the share of computed requests that were coalesced
+        # onto an in-flight computation, and the share of computations that
+        # were partly or wholly composed from stored regions
+        stats = self._read_stats()
+        for counters in stats.values():
+            hits = counters.get('hit', 0)
+            leaders = counters.get('leader', 0)
+            coalesced = counters.get('coalesced', 0)
+            if leaders + coalesced > 0:
+                counters['coalesced_rate'] = float(coalesced) / (leaders + coalesced)
+            if hits + leaders + coalesced > 0:
+                counters['hit_rate'] = float(hits) / (hits + leaders + coalesced)
+            if leaders > 0:
+                counters['composed_rate'] = float(counters.get('composed', 0)) / leaders
+        return stats
+
+
+# Flights this process is the leader of and has not published yet
+_leading = []
+
+
+def abandon_flights():
+    # Release the keys of all unpublished flights of this process, for worker
+    # processes whose script failed
+    for flight in list(_leading):
+        flight.abandon()
+
+
+class Flight(object):
+    """Single-flight execution of one request across processes.
+
+    join() either returns the result text already in the store or computed by
+    another process that was working on the same key, or returns None, in which
+    case the caller is the leader for the key and must compute the result and
+    call publish().
+    """
+    def __init__(self, store, family, coords, params=None):
+        self.store = store
+        self.family = family
+        self.variant = make_variant(family, params)
+        self.key = make_key(family, coords, params)
+        self._lock = None
+        self._live = None
+
+    def join(self):
+        result = self.store.get(self.key)
+        if result is not None:
+            self.store.incr(self.family, 'hit')
+            return result
+        while True:
+            started = time.time()
+            f = open(self.store.lock_path(self.key), 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    f.close()
+                    raise
+            else:
+                # Another process may have published the result between the
+                # store lookup and taking the lock
+                result = self.store.get(self.key)
+                if result is not None:
+                    f.close()
+                    self.store.incr(self.family, 'hit')
+                    return result
+                self._lock = f
+                _leading.append(self)
+                self.store.incr(self.family, 'leader')
+                if os.environ.get('DT_PRIORITY', INTERACTIVE) == INTERACTIVE:
+                    self._live = self.store.mark_live()
+                return None
+            # Another process is computing this result - wait for it to
+            # release the lock, then pick up what it published
+            fcntl.flock(f, fcntl.LOCK_SH)
+            f.close()
+            result = self.store.get(self.key, since=started)
+            if result is not None:
+                self.store.incr(self.family, 'coalesced')
+                return result
+            # The leader exited without publishing a result, so try to take
+            # over the computation
+
+    def publish(self, text, raw=None, coords=None):
+        self.store.put(self.key, text, raw, self.variant, coords)
+        self.abandon()
+
+    def abandon(self):
+        # Release the key without publishing a result, e.g. after a failed
+        # query. Waiting processes then take over the computation. Locks are
+        # also released when the process exits.
+        if self in _leading:
+            _leading.remove(self)
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+        if self._live is not None:
+            self._live.close()
+            self._live = None
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['stats']:
+        sys.exit('usage: python results.py stats')
+    sys.stdout.write(json.dumps(ResultStore().stats(), indent=4, sort_keys=True))
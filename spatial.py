@@ -0,0 +1,135 @@
+# Composition of results for new AOIs from regions already in the result store.
+#
+# Many requests are unions of regions that have already been computed (e.g.
+# "these four districts"), or are mostly covered by them. For families whose
+# raw outputs are additive (class hectares, transitions, population, forest
+# loss, emissions, SOC tons), compose() looks up stored AOIs of the same
+# variant whose bounding boxes lie within that of the new AOI in the R*Tree of
+# the result store, picks non-overlapping ones that lie within the new AOI, and
+# sums their raw values. Only the part of the AOI they don't cover is left to
+# compute on Earth Engine.
+#
+# Requires shapely. Without it, or if shapely fails on a geometry, compose()
+# leaves the whole AOI to compute.
+
+import sys
+import json
+
+try:
+    from shapely.geometry import shape, mapping
+except ImportError:
+    shape = None
+try:
+    from shapely.validation import make_valid
+except ImportError:
+    make_valid = None
+
+from results import bounding_box
+
+# Fraction of the area of a region that may fall outside the AOI or overlap
+# another chosen region, and fraction of the AOI that may be left uncovered,
+# to allow for differences in how shared borders were digitized
+TOLERANCE = 1e-4
+
+
+def multipolygon_coords(coords):
+    # Pad coordinates to MultiPolygon depth, as ee.Geometry.MultiPolygon does
+    # for the coordinates of a single polygon or ring
+    depth = 0
+    c = coords
+    while isinstance(c, (list, tuple)) and c:
+        depth += 1
+        c = c[0]
+    for n in range(depth, 4):
+        coords = [coords]
+    return coords
+
+
+def multipolygon(coords):
+    geom = shape({'type': 'MultiPolygon', 'coordinates': multipolygon_coords(coords)})
+    if not geom.is_valid:
+        # Repair self-intersecting polygons, which make overlay operations fail
+        geom = make_valid(geom) if make_valid is not None else geom.buffer(0)
+    return geom
+
+
+def polygon_coords(geom):
+    # MultiPolygon coordinates of the polygons in a geometry
+    if geom.geom_type == 'Polygon':
+        polygons = [geom]
+    elif geom.geom_type in ['MultiPolygon', 'GeometryCollection']:
+        polygons = [g for g in geom.geoms if g.geom_type == 'Polygon']
+    else:
+        polygons = []
+    # Round trip through json to turn tuples into lists
+    return json.loads(json.dumps([mapping(p)['coordinates'] for p in polygons]))
+
+
+def sum_raw(a, b):
+    # Sum two sets of raw values, which may be numbers or (nested) dictionaries
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if isinstance(a, dict):
+        return dict((key, sum_raw(a.get(key), b.get(key))) for key in set(a) | set(b))
+    return a + b
+
+
+class SpatialIndex(object):
+    def __init__(self, store, variant):
+        self.store = store
+        self.variant = variant
+
+    def candidates(self, coords):
+        # Keys of the stored regions whose bounding box lies within that of
+        # the AOI, allowing for the tolerance
+        box = bounding_box(coords)
+        margin = TOLERANCE * max(box[2] - box[0], box[3] - box[1])
+        return self.store.index_candidates(self.variant, box, margin)
+
+    def cover(self, coords):
+        # Returns the keys of non-overlapping stored regions lying within the
+        # AOI, largest first, and the MultiPolygon coordinates of the part of
+        # the AOI they leave uncovered, or None if they cover all of it. Only
+        # the geometries of candidate regions are read.
+        aoi = multipolygon(coords)
+        geoms = {}
+        for key in self.candidates(coords):
+            geom = multipolygon(self.store.index_coords(self.variant, key))
+            if geom.difference(aoi).area <= TOLERANCE * geom.area:
+                geoms[key] = geom
+        keys = []
+        covered = None
+        for key in sorted(geoms, key=lambda key: -geoms[key].area):
+            geom = geoms[key]
+            if covered is not None and geom.intersection(covered).area > TOLERANCE * geom.area:
+                continue
+            keys.append(key)
+            covered = geom if covered is None else covered.union(geom)
+        if covered is None:
+            return keys, coords
+        remainder = aoi.difference(covered)
+        if remainder.area <= TOLERANCE * aoi.area:
+            return keys, None
+        return keys, polygon_coords(remainder) or None
+
+
+def compose(flight, coords):
+    # Returns the summed raw values of stored regions covering part of the
+    # AOI, and the coordinates of the part still to compute (None if there is
+    # nothing left to compute)
+    if shape is None:
+        return None, coords
+    try:
+        keys, remainder = SpatialIndex(flight.store, flight.variant).cover(coords)
+        raw = None
+        for key in keys:
+            raw = sum_raw(raw, flight.store.get_raw(key))
+    except Exception as e:
+        # Composition is only a shortcut, so compute the whole AOI instead
+        sys.stderr.write('composing {} failed, computing the whole AOI: {!r}\n'.format(flight.key, e))
+        return None, coords
+    if keys:
+        flight.store.incr(flight.family, 'composed')
+    return raw, remainder
@@ -0,0 +1,66 @@
+import os
+import sys
+import types
+
+import pytest
+
+# The modules under test are top-level scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Stub(object):
+    """Stand-in for Earth Engine objects that records the calls made on it.
+
+    Every attribute access and call returns a new Stub with the call appended
+    to calls, e.g. ee.Image('a').unmask(0).calls is
+    [('Image', ('a',), {}), ('unmask', (0,), {})]. getInfo() returns what
+    the test's get_info function returns for the stub.
+    """
+    def __init__(self, module, calls):
+        self._module = module
+        self.calls = calls
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub(self._module, self.calls + [(name, (), {})])
+
+    def __call__(self, *args, **kwargs):
+        name = self.calls[-1][0]
+        return Stub(self._module, self.calls[:-1] + [(name, args, kwargs)])
+
+    def getInfo(self):
+        return self._module.get_info(self)
+
+    def names(self):
+        return [call[0] for call in self.calls]
+
+    def find(self, name):
+        # Arguments of the last call of the given name
+        for call in reversed(self.calls):
+            if call[0] == name:
+                return call[1], call[2]
+        raise KeyError(name)
+
+
+class StubModule(types.ModuleType):
+    def __init__(self):
+        types.ModuleType.__init__(self, 'ee')
+        self.get_info = lambda stub: None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub(self, [(name, (), {})])
+
+
+@pytest.fixture
+def ee(monkeypatch):
+    """A stub ee module, with common and layers imported against it."""
+    module = StubModule()
+    monkeypatch.setitem(sys.modules, 'ee', module)
+    for name in ['common', 'layers']:
+        sys.modules.pop(name, None)
+    yield module
+    for name in ['common', 'layers']:
+        sys.modules.pop(name, None)
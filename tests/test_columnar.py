@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from columnar import ColumnarWriter, SCHEMAS, DOUBLE, flatten, get_rows, export
+
+
+def write(path, rows, columns=None, row_group_size=2):
+    writer = ColumnarWriter(path, columns, row_group_size)
+    for row in rows:
+        writer.write(row)
+    writer.close()
+    return pq.ParquetFile(path)
+
+
+def test_flatten():
+    assert flatten({'a': 1, 'b': {'c': 2, 'd': {'e': 3}}}) == {'a': 1, 'b.c': 2, 'b.d.e': 3}
+
+
+def test_iucn_rows_per_species():
+    result = {'iucn_mammals': [{'binomial': 'a b', 'code': 'CR'}, {'binomial': 'c d', 'code': 'EN'}]}
+    rows = list(get_rows('region_metrics_iucn', 'x', result))
+    assert [row['binomial'] for row in rows] == ['a b', 'c d']
+    assert all(row['aoi'] == 'x' for row in rows)
+
+
+def test_multiple_row_groups(tmpdir):
+    path = str(tmpdir.join('out.parquet'))
+    f = write(path, [{'aoi': str(n), 'x': float(n)} for n in range(5)])
+    assert f.metadata.num_row_groups == 3
+    table = f.read()
+    assert table.column('x').to_pylist() == [0., 1., 2., 3., 4.]
+    assert table.schema.field('x').type == DOUBLE
+
+
+def test_null_first_column_becomes_string(tmpdir):
+    path = str(tmpdir.join('out.parquet'))
+    rows = [{'aoi': 'a', 'code': None}, {'aoi': 'b', 'code': None},
+            {'aoi': 'c', 'code': 'CR'}]
+    table = write(path, rows).read()
+    assert table.column('code').to_pylist() == [None, None, 'CR']
+
+
+def test_declared_columns(tmpdir):
+    path = str(tmpdir.join('out.parquet'))
+    rows = [{'aoi': 'a', 'binomial': 'a b', 'code': None}, {'aoi': 'b', 'binomial': 'c d', 'code': None},
+            {'aoi': 'c', 'binomial': 'e f', 'code': 'VU', 'degradation.aoi.stable': 50.}]
+    table = write(path, rows, SCHEMAS['region_metrics_iucn']).read()
+    assert table.schema.names[:3] == ['aoi', 'binomial', 'code']
+    assert table.column('code').to_pylist() == [None, None, 'VU']
+    assert table.column('degradation.aoi.stable').to_pylist() == [None, None, 50.]
+
+
+def test_new_column_in_later_group_fails(tmpdir):
+    path = str(tmpdir.join('out.parquet'))
+    rows = [{'aoi': 'a', 'x': 1.}, {'aoi': 'b', 'x': 2.}, {'aoi': 'c', 'x': 3., 'y': 4.}]
+    with pytest.raises(ValueError):
+        write(path, rows)
+
+
+def make_queue(tmpdir, results):
+    from worker import JobQueue
+    queue = JobQueue(str(tmpdir.join('jobs.db')))
+    for family, name, result in results:
+        queue.enqueue(family, '{}', name)
+        job_id = queue.claim('w')[0]
+        queue.finish('w', job_id, json.dumps(result))
+    return queue
+
+
+def species(binomial, **attributes):
+    d = {'binomial': binomial, 'code': 'CR',
+         'degradation': {'aoi': {'stable': 50.}, 'entire range': {'stable': 40.}}}
+    d.update(attributes)
+    return d
+
+
+def test_export_columns_from_all_rows(tmpdir):
+    # An attribute that only appears in the last row is kept
+    queue = make_queue(tmpdir, [('region_metrics_iucn', 'a', {'iucn_mammals': [species('a b')]}),
+                                ('region_metrics_iucn', 'b', {'iucn_mammals': [species('c d', id_no=7)]}),
+                                ('region_metrics_emissions', 'a', {'carbon_emissions_tons_co2e': 1.})])
+    output = tmpdir.join('out')
+    export(queue, str(output), row_group_size=1)
+    table = pq.read_table(str(output.join('region_metrics_iucn.parquet')))
+    assert table.column('id_no').to_pylist() == [None, 7.]
+    assert table.column('binomial').to_pylist() == ['a b', 'c d']
+    table = pq.read_table(str(output.join('region_metrics_emissions.parquet')))
+    assert table.column('carbon_emissions_tons_co2e').to_pylist() == [1.]
+
+
+def test_export_failure_leaves_no_partial_files(tmpdir):
+    queue = make_queue(tmpdir, [('region_metrics_emissions', 'a', {'carbon_emissions_tons_co2e': 1.}),
+                                ('region_metrics_emissions', 'b', {'carbon_emissions_tons_co2e': 'x'})])
+    output = tmpdir.join('out')
+    with pytest.raises(pa.ArrowInvalid):
+        export(queue, str(output), row_group_size=1)
+    assert output.listdir() == []
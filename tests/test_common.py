@@ -0,0 +1,113 @@
+import pytest
+
+AOI = 'aoi'
+
+
+@pytest.fixture
+def common(ee):
+    import common
+    return common
+
+
+def test_class_areas(ee, common):
+    ee.get_info = lambda stub: {'groups': [{'class': 1.0, 'sum': 2.5}, {'class': -1.0, 'sum': 1.}]}
+    image = ee.Image('a')
+    assert common.get_class_areas(image, AOI) == {1: 2.5, -1: 1.}
+
+
+def test_class_area_pairs(ee, common):
+    ee.get_info = lambda stub: {'groups': [{'class': 1.0, 'groups': [{'second': 11.0, 'sum': 2.},
+                                                                      {'second': -32768.0, 'sum': 1.}]},
+                                           {'class': 0.0, 'groups': [{'second': 22.0, 'sum': 3.}]}]}
+    areas = common.get_class_areas(ee.Image('a'), AOI, second=ee.Image('b'))
+    assert areas == {(1, 11): 2., (1, -32768): 1., (0, 22): 3.}
+
+
+def test_class_area_pairs_unmask_second(ee, common):
+    infos = []
+    def get_info(stub):
+        infos.append(stub)
+        return {'groups': []}
+    ee.get_info = get_info
+    common.get_class_areas(ee.Image('a'), AOI, second=ee.Image('b'))
+    # The second band is added to the stack with its masked pixels set to
+    # NODATA, so that they still count towards the classes of the first
+    second = [args[0] for name, args, kwargs in infos[0].calls
+              if name == 'addBands' and args[0].calls[0] == ('Image', ('b',), {})]
+    assert second[0].calls[-1] == ('unmask', (common.NODATA,), {})
+
+
+
+@pytest.fixture
+def collection(ee):
+    # Stub feature collection of n features, recording the pages requested
+    requests = {'pages': [], 'size': 0}
+    def get_info(stub):
+        if stub.names()[-1] == 'size':
+            requests['size'] += 1
+            return requests['n']
+        page_size, offset = stub.calls[0][1][0].find('toList')[0]
+        requests['pages'].append(offset)
+        return {'features': [{'properties': {'i': i}}
+                             for i in range(offset, min(offset + page_size, requests['n']))]}
+    ee.get_info = get_info
+    def make(n):
+        requests['n'] = n
+        return ee.FeatureCollection('fc'), requests
+    return make
+
+
+@pytest.mark.parametrize('n', [0, 3, 5, 12, 20])
+def test_paging(common, collection, n):
+    fc, requests = collection(n)
+    rows = [p['i'] for p in common.iter_fc_properties(fc, page_size=5, concurrency=3)]
+    assert rows == list(range(n))
+    # No page is requested past the end of the collection, and the features
+    # are only counted when they don't fit in one page
+    assert sorted(requests['pages']) == list(range(0, max(n, 1), 5))
+    assert requests['size'] == (1 if n >= 5 else 0)
+
+
+def test_paging_error(common, collection, ee):
+    fc, requests = collection(12)
+    def get_info(stub):
+        raise RuntimeError('quota')
+    ee.get_info = get_info
+    with pytest.raises(RuntimeError):
+        list(common.iter_fc_properties(fc, page_size=5))
+
+
+def test_progress_reported_around_queries(common, monkeypatch):
+    events = []
+    monkeypatch.setattr(common, 'on_progress', lambda: events.append('progress'))
+    common.join_all([common.GEECall(events.append, 'query')])
+    assert events == ['progress', 'query', 'progress']
+
+
+def test_area_weighted_sum(ee, common):
+    infos = []
+    def get_info(stub):
+        infos.append(stub)
+        return {'sum': 30., 'area': 20.}
+    ee.get_info = get_info
+    raw = common.get_area_weighted_sum(ee.Image('a'), AOI, 250)
+    assert raw == {'sum': 30., 'area': 20.}
+    assert common.get_mean(raw) == 1.5
+    # Both bands are summed with the same (area-weighted) reducer
+    assert infos[0].find('reduceRegion')[1]['reducer'].names() == ['Reducer', 'sum']
+
+
+def test_area_weighted_sum_without_pixels(ee, common):
+    ee.get_info = lambda stub: {'sum': None, 'area': None}
+    raw = common.get_area_weighted_sum(ee.Image('a'), AOI, 250)
+    assert raw == {'sum': 0, 'area': 0}
+    assert common.get_mean(raw) is None
+
+
+def test_composed_mean_is_area_weighted(common):
+    # Two regions with different means: the composed mean weighs them by the
+    # area with values, whatever scale each was computed at
+    fine = {'sum': 10., 'area': 10.}
+    coarse = {'sum': 90., 'area': 30.}
+    composed = {'sum': fine['sum'] + coarse['sum'], 'area': fine['area'] + coarse['area']}
+    assert common.get_mean(composed) == 2.5
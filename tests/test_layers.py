@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+import results
+
+AOI = 'aoi'
+
+
+@pytest.fixture
+def layers(ee, tmpdir, monkeypatch):
+    import layers
+    path = str(tmpdir.join('prepared_layers.json'))
+    monkeypatch.setattr(results, 'REGISTRY_PATH', path)
+    monkeypatch.setattr(layers, 'REGISTRY_PATH', path)
+    return layers
+
+
+def register(layers, name, source=None, scale=None, asset='users/x/kba_prepared_300m', mtime=None):
+    layer = layers.LAYERS[name]
+    registry = {name: {'asset': asset, 'scale': scale or layer['scale'],
+                       'source': source or layer['collection']}}
+    with open(layers.REGISTRY_PATH, 'w') as f:
+        json.dump(registry, f)
+    if mtime is not None:
+        os.utime(layers.REGISTRY_PATH, (mtime, mtime))
+
+
+def is_rasterized(image, layers, name):
+    return image.calls[0] == ('FeatureCollection', (layers.LAYERS[name]['collection'],), {}) \
+        and image.calls[1] == ('filterBounds', (AOI,), {})
+
+
+def test_fallback_without_registry(layers):
+    assert is_rasterized(layers.get_layer('kba', AOI, 300), layers, 'kba')
+
+
+def test_registered_raster_used_at_coarser_scale(layers):
+    register(layers, 'kba')
+    image = layers.get_layer('kba', AOI, 300)
+    assert image.calls == [('Image', ('users/x/kba_prepared_300m',), {})]
+    assert layers.get_layer('kba', AOI, 1000).calls == image.calls
+
+
+def test_fallback_at_finer_scale(layers):
+    register(layers, 'kba')
+    assert is_rasterized(layers.get_layer('kba', AOI, 30), layers, 'kba')
+    assert is_rasterized(layers.get_layer('kba', AOI), layers, 'kba')
+
+
+def test_fallback_on_source_mismatch(layers):
+    register(layers, 'kba', source='users/x/old_kba')
+    assert is_rasterized(layers.get_layer('kba', AOI, 300), layers, 'kba')
+
+
+def test_other_layers_not_affected(layers):
+    register(layers, 'kba')
+    assert is_rasterized(layers.get_layer('pas', AOI, 300), layers, 'pas')
+
+
+def test_registry_reloaded_on_change(layers):
+    register(layers, 'kba', source='users/x/old_kba', mtime=1000)
+    assert is_rasterized(layers.get_layer('kba', AOI, 300), layers, 'kba')
+    register(layers, 'kba', mtime=2000)
+    assert layers.get_layer('kba', AOI, 300).names() == ['Image']
+
+
+def test_presence_and_value_layers(layers):
+    kba = layers.get_layer('kba', AOI, 30)
+    assert kba.find('reduceToImage')[1]['properties'] == ['OBJECTID']
+    assert 'gte' in kba.names()
+    livelihoods = layers.get_layer('livelihoods', AOI, 30)
+    assert 'filter' in livelihoods.names()
+    assert 'gte' not in livelihoods.names()
+    assert livelihoods.calls[-1] == ('unmask', (0,), {})
+
+
+def test_registry_in_dataset_version(layers):
+    before = results.dataset_version('restoration_metrics')
+    unaffected = results.dataset_version('region_metrics_iucn')
+    register(layers, 'kba')
+    assert results.dataset_version('restoration_metrics') != before
+    # region_metrics_iucn doesn't use the kba layer
+    assert results.dataset_version('region_metrics_iucn') == unaffected
@@ -0,0 +1,62 @@
+import json
+import time
+
+import pytest
+
+import progressive
+
+# Stand-in metric script: the preview (run with DT_SCALE) and final passes
+# sleep for the given number of seconds and report the scale they ran at
+SCRIPT = """
+import os
+import sys
+import json
+import time
+preview = bool(os.environ.get('DT_SCALE'))
+time.sleep({preview_delay} if preview else {final_delay})
+if not preview and {final_fails}:
+    sys.exit(3)
+sys.stdout.write(json.dumps({{'value': 1. if preview else 1.5, 'name': 'x'}}))
+"""
+
+
+@pytest.fixture
+def run(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(progressive, 'HERE', str(tmpdir))
+    def run(preview_delay, final_delay, final_fails=False):
+        tmpdir.join('metrics.py').write(SCRIPT.format(preview_delay=preview_delay, final_delay=final_delay,
+                                                      final_fails=final_fails))
+        code = progressive.run('metrics', '{}')
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        return code, lines
+    return run
+
+
+def test_preview_then_final(run):
+    code, lines = run(0, 0.5)
+    assert code == 0
+    assert [line['preview'] for line in lines] == [True, False]
+    assert lines[0]['results']['value'] == 1.
+    assert lines[1]['results']['value'] == 1.5
+    assert lines[1]['preview_difference'] == {'value': 0.5}
+
+
+def test_final_first_drops_preview(run):
+    start = time.time()
+    code, lines = run(5, 0)
+    assert time.time() - start < 4
+    assert code == 0
+    assert [line['preview'] for line in lines] == [False]
+    assert 'preview_difference' not in lines[0]
+
+
+def test_final_failure(run):
+    code, lines = run(0, 0.5, final_fails=True)
+    assert code == 3
+    assert [line['preview'] for line in lines] == [True]
+
+
+def test_preview_difference():
+    assert progressive.preview_difference({'a': 1, 'b': {'c': 2.}, 'd': 'x', 'e': [1, 2]},
+                                          {'a': 3, 'b': {'c': 1.}, 'd': 'y', 'e': [2, 2]}) == \
+        {'a': 2, 'b': {'c': -1.}, 'e': [1, 0]}
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+import results
+from results import ResultStore, Flight, abandon_flights, normalize_coords, make_key
+
+AOI = [[[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]]
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    monkeypatch.setenv('DT_PRIORITY', results.BACKGROUND)
+    return ResultStore(str(tmpdir.join('store')))
+
+
+def join_in_thread(flight):
+    ret = {}
+    def run():
+        ret['result'] = flight.join()
+    thread = threading.Thread(target=run)
+    thread.start()
+    # Give the thread time to block on the lock
+    thread.join(0.2)
+    return thread, ret
+
+
+def test_keys_ignore_coordinate_noise():
+    noisy = [[[[1e-9, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]]
+    assert normalize_coords(noisy) == normalize_coords(AOI)
+    assert make_key('region_metrics', noisy) == make_key('region_metrics', AOI)
+    assert make_key('region_metrics', AOI, {'scale': 1000}) != make_key('region_metrics', AOI)
+
+
+def test_leader_then_hit(store):
+    leader = Flight(store, 'region_metrics', AOI)
+    assert leader.join() is None
+    leader.publish('result')
+    assert Flight(store, 'region_metrics', AOI).join() == 'result'
+    stats = store.stats()['region_metrics']
+    assert stats['leader'] == 1
+    assert stats['hit'] == 1
+
+
+def test_coalesced(store):
+    leader = Flight(store, 'region_metrics', AOI)
+    assert leader.join() is None
+    thread, ret = join_in_thread(Flight(store, 'region_metrics', AOI))
+    assert thread.is_alive()
+    leader.publish('result')
+    thread.join()
+    assert ret['result'] == 'result'
+    assert store.stats()['region_metrics']['coalesced'] == 1
+
+
+def test_takeover_after_abandon(store):
+    leader = Flight(store, 'region_metrics', AOI)
+    assert leader.join() is None
+    follower = Flight(store, 'region_metrics', AOI)
+    thread, ret = join_in_thread(follower)
+    assert thread.is_alive()
+    # The leader failed without publishing, so the follower computes the result
+    abandon_flights()
+    thread.join()
+    assert ret['result'] is None
+    follower.publish('result')
+    assert store.get(leader.key) == 'result'
+    assert store.stats()['region_metrics']['leader'] == 2
+
+
+def test_raw_index(store):
+    flight = Flight(store, 'region_metrics', AOI)
+    flight.join()
+    flight.publish('result', {'area_hectares': 1.}, AOI)
+    assert store.get_raw(flight.key) == {'area_hectares': 1.}
+    assert store.index_candidates(flight.variant, [0, 0, 1, 1]) == [flight.key]
+    assert store.index_candidates(flight.variant, [0, 0, 0.5, 1]) == []
+    assert store.index_candidates('other', [0, 0, 1, 1]) == []
+    # Publishing the same AOI again doesn't add it twice
+    flight.publish('result', {'area_hectares': 1.}, AOI)
+    assert store.index_candidates(flight.variant, [-1, -1, 2, 2]) == [flight.key]
+    assert store.index_coords(flight.variant, flight.key) == normalize_coords(AOI)
+
+
+def test_variant_changes_with_code(tmpdir, monkeypatch):
+    for name in ['region_metrics.py', 'common.py', 'layers.py']:
+        tmpdir.join(name).write('x = ee.Image("a/b")\n')
+    monkeypatch.setattr(results, 'HERE', str(tmpdir))
+    variant = results.make_variant('region_metrics')
+    datasets = results.dataset_version('region_metrics')
+    tmpdir.join('common.py').write('x = ee.Image("a/b")\ny = 1\n')
+    assert results.make_variant('region_metrics') != variant
+    assert results.dataset_version('region_metrics') == datasets
+
+
+def test_is_idle(store):
+    assert store.is_idle()
+    live = store.mark_live()
+    assert not store.is_idle()
+    live.close()
+    assert store.is_idle()
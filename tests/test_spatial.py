@@ -0,0 +1,122 @@
+import json
+
+import pytest
+
+pytest.importorskip('shapely')
+
+import spatial
+from results import ResultStore, Flight
+from spatial import SpatialIndex, compose, multipolygon, sum_raw
+
+
+def square(x0, y0, x1, y1):
+    return [[[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]]
+
+
+def make_store(tmpdir, regions):
+    # Store each (coords, raw) region as a computed result
+    store = ResultStore(str(tmpdir.join('store')))
+    for coords, raw in regions:
+        flight = Flight(store, 'region_metrics', coords)
+        assert flight.join() is None
+        flight.publish(json.dumps(raw), raw, coords)
+    return store
+
+
+def test_sum_raw():
+    assert sum_raw({'a': 1, 'b': {'c': 2}}, {'a': 2, 'b': {'c': 3, 'd': 1}}) == \
+        {'a': 3, 'b': {'c': 5, 'd': 1}}
+    assert sum_raw(None, {'a': 1}) == {'a': 1}
+
+
+def test_polygon_depth_coordinates():
+    polygon = square(0, 0, 1, 1)[0]
+    assert multipolygon(polygon).equals(multipolygon(square(0, 0, 1, 1)))
+    assert multipolygon(polygon[0]).equals(multipolygon(square(0, 0, 1, 1)))
+
+
+def test_invalid_geometry_is_repaired():
+    bowtie = [[[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]]
+    geom = multipolygon(bowtie)
+    assert geom.is_valid
+    assert geom.area == pytest.approx(0.5)
+
+
+def test_exact_union(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.}),
+                                (square(1, 0, 2, 1), {'area_hectares': 2.})])
+    flight = Flight(store, 'region_metrics', square(0, 0, 2, 1))
+    assert flight.join() is None
+    raw, remainder = compose(flight, square(0, 0, 2, 1))
+    assert raw == {'area_hectares': 3.}
+    assert remainder is None
+    assert store.stats()['region_metrics']['composed'] == 1
+
+
+def test_partial_cover(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.}),
+                                (square(5, 5, 6, 6), {'area_hectares': 5.})])
+    flight = Flight(store, 'region_metrics', square(0, 0, 2, 1))
+    raw, remainder = compose(flight, square(0, 0, 2, 1))
+    assert raw == {'area_hectares': 1.}
+    assert multipolygon(remainder).equals(multipolygon(square(1, 0, 2, 1)))
+
+
+def test_overlapping_regions_are_not_double_counted(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 2, 1), {'area_hectares': 2.}),
+                                (square(1, 0, 2, 1), {'area_hectares': 1.})])
+    keys, remainder = SpatialIndex(store, Flight(store, 'region_metrics', square(0, 0, 3, 1)).variant) \
+        .cover(square(0, 0, 3, 1))
+    assert len(keys) == 1
+    assert multipolygon(remainder).equals(multipolygon(square(2, 0, 3, 1)))
+
+
+def test_polygon_depth_aoi(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.}),
+                                (square(1, 0, 2, 1)[0], {'area_hectares': 2.})])
+    aoi = square(0, 0, 2, 1)[0]
+    raw, remainder = compose(Flight(store, 'region_metrics', aoi), aoi)
+    assert raw == {'area_hectares': 3.}
+    assert remainder is None
+
+
+def test_invalid_aoi(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.})])
+    bowtie = [[[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]]
+    raw, remainder = compose(Flight(store, 'region_metrics', bowtie), bowtie)
+    assert remainder is not None
+
+
+def test_compose_falls_back_on_errors(tmpdir, monkeypatch):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.})])
+    def fail(coords):
+        raise ValueError('bad geometry')
+    monkeypatch.setattr(spatial, 'multipolygon', fail)
+    aoi = square(0, 0, 2, 1)
+    assert compose(Flight(store, 'region_metrics', aoi), aoi) == (None, aoi)
+
+
+def test_only_candidate_geometries_are_read(tmpdir):
+    store = make_store(tmpdir, [(square(0, 0, 1, 1), {'area_hectares': 1.}),
+                                (square(5, 5, 6, 6), {'area_hectares': 5.})])
+    read = []
+    index_coords = store.index_coords
+    def record(variant, key):
+        read.append(key)
+        return index_coords(variant, key)
+    store.index_coords = record
+    aoi = square(0, 0, 2, 1)
+    compose(Flight(store, 'region_metrics', aoi), aoi)
+    assert len(read) == 1
+
+
+def test_exact_fit_of_small_regions(tmpdir):
+    # Bounding boxes of exactly fitting regions are found despite the R*Tree
+    # storing them as 32-bit floats
+    x, y = 100.1234567, -10.7654321
+    store = make_store(tmpdir, [(square(x, y, x + 1e-3, y + 1e-3), {'area_hectares': 1.}),
+                                (square(x + 1e-3, y, x + 2e-3, y + 1e-3), {'area_hectares': 2.})])
+    aoi = square(x, y, x + 2e-3, y + 1e-3)
+    raw, remainder = compose(Flight(store, 'region_metrics', aoi), aoi)
+    assert raw == {'area_hectares': 3.}
+    assert remainder is None
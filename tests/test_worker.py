@@ -0,0 +1,88 @@
+import time
+
+import worker
+from worker import JobQueue, MAX_ATTEMPTS
+
+
+def make_queue(tmpdir):
+    return JobQueue(str(tmpdir.join('jobs.db')))
+
+
+def get_job(queue, job_id):
+    return queue._execute('SELECT status, attempts, error, result FROM jobs WHERE id = ?', (job_id,))[0]
+
+
+def make_stale(queue, job_id):
+    queue._execute('UPDATE jobs SET heartbeat = ? WHERE id = ?',
+                   (time.time() - 2 * worker.HEARTBEAT * worker.MISSED_HEARTBEATS, job_id))
+
+
+def test_claim_by_priority_then_order(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}', 'b', 1)
+    queue.enqueue('region_metrics', '{}', 'c', 1)
+    queue.enqueue('region_metrics', '{}', 'a', 0)
+    names = [queue.claim('w')[2] for n in range(3)]
+    assert names == ['a', 'b', 'c']
+    assert queue.claim('w') is None
+
+
+def test_claim_marks_running(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}')
+    job_id = queue.claim('w')[0]
+    status, attempts, error, result = get_job(queue, job_id)
+    assert status == 'running'
+    assert attempts == 1
+
+
+def test_finish_and_results(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}', 'a')
+    queue.heartbeat('w')
+    job_id = queue.claim('w')[0]
+    queue.finish('w', job_id, '{"x": 1}')
+    assert list(queue.iter_results()) == [('region_metrics', 'a', '{"x": 1}')]
+    status = queue.status()
+    assert status['jobs'] == {'done': 1}
+    assert status['workers']['w']['jobs_done'] == 1
+
+
+def test_fail_requeues_until_max_attempts(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}')
+    for n in range(MAX_ATTEMPTS):
+        job_id = queue.claim('w')[0]
+        queue.fail(job_id, 'error {}'.format(n))
+    status, attempts, error, result = get_job(queue, job_id)
+    assert status == 'failed'
+    assert attempts == MAX_ATTEMPTS
+    assert error == 'error {}'.format(MAX_ATTEMPTS - 1)
+    assert queue.claim('w') is None
+
+
+def test_requeue_stale(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}')
+    job_id = queue.claim('w')[0]
+    # Jobs with recent heartbeats are left alone
+    queue.requeue_stale()
+    assert get_job(queue, job_id)[0] == 'running'
+    make_stale(queue, job_id)
+    queue.requeue_stale()
+    assert get_job(queue, job_id)[0] == 'queued'
+    assert queue.claim('w')[0] == job_id
+
+
+def test_requeue_stale_respects_max_attempts(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.enqueue('region_metrics', '{}')
+    for n in range(MAX_ATTEMPTS):
+        job_id = queue.claim('w')[0]
+        make_stale(queue, job_id)
+        queue.requeue_stale()
+    status, attempts, error, result = get_job(queue, job_id)
+    assert status == 'failed'
+    assert attempts == MAX_ATTEMPTS
+    assert 'heartbeats' in error
+    assert queue.claim('w') is None
@@ -0,0 +1,131 @@
+# Script to precompute statistics for a catalog of predefined regions (countries,
+# admin units, project sites) so that the first query for each of them during a
+# presentation is served from the result store.
+#
+#  Takes the path to a GeoJSON FeatureCollection with one feature per region.
+# An optional numeric "priority" property orders the regions (lower values are
+# warmed first) and an optional "name" property is used in log messages.
+#
+#     python warmup.py catalog.geojson --concurrency 2 --quota-share 0.5
+#
+#  Warm-up jobs run the metric scripts with DT_PRIORITY=background. They only
+# start while no interactive request is being computed, and pause before each
+# Earth Engine query while one is, so live requests from the theater get most
+# of the quota. Queries a job has already sent are not interrupted.
+#
+#  With --watch, the catalog is re-warmed whenever the asset IDs used by a
+# metric family or its registered prepared layers change. Only those changes
+# trigger a re-warm: after a change to the code of a metric family, which also
+# invalidates its stored results, run the warm-up again by hand.
+#
+#  With --queue, jobs are added to the job queue of a worker pool (see
+# worker.py) instead of being run by this process.
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+try:
+    from Queue import PriorityQueue, Empty
+except ImportError:
+    from queue import PriorityQueue, Empty
+
+from common import GEECall
+from results import ResultStore, BACKGROUND, HERE, dataset_version
+from worker import JobQueue
+
+FAMILIES = ['region_metrics', 'restoration_metrics', 'region_metrics_emissions',
+            'region_metrics_iucn']
+
+
+def load_catalog(path):
+    with open(path) as f:
+        catalog = json.load(f)
+    regions = []
+    for n, feature in enumerate(catalog['features']):
+        properties = feature.get('properties') or {}
+        regions.append((properties.get('priority', 0),
+                        properties.get('name', 'region {}'.format(n)),
+                        json.dumps(feature)))
+    return regions
+
+
+def run_job(family, geojson):
+    env = dict(os.environ, DT_PRIORITY=BACKGROUND)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(HERE, family + '.py'), geojson],
+                              stdout=devnull, env=env)
+
+
+def warm_worker(queue, store, quota_share):
+    while True:
+        try:
+            priority, seq, family, name, geojson = queue.get_nowait()
+        except Empty:
+            return
+        # Don't start a new job while an interactive request is being
+        # computed. Running jobs pause between queries instead.
+        store.wait_until_idle()
+        start = time.time()
+        try:
+            run_job(family, geojson)
+        except subprocess.CalledProcessError as e:
+            sys.stderr.write('warm-up of {} for {} failed: {}\n'.format(family, name, e))
+        # Sleep in proportion to the time spent so that this worker uses at
+        # most quota_share of the time it is running
+        time.sleep((time.time() - start) * (1 - quota_share) / quota_share)
+
+
+def warm(regions, families, store, concurrency=1, quota_share=1.):
+    queue = PriorityQueue()
+    seq = 0
+    for priority, name, geojson in regions:
+        for family in families:
+            queue.put((priority, seq, family, name, geojson))
+            seq += 1
+    threads = [GEECall(warm_worker, queue, store, quota_share) for n in range(concurrency)]
+    for t in threads:
+        t.join()
+
+
+def enqueue(regions, families, queue):
+    for priority, name, geojson in regions:
+        for family in families:
+            queue.enqueue(family, geojson, name, priority)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute region statistics into the result store.')
+    parser.add_argument('catalog', help='GeoJSON FeatureCollection of regions to warm')
+    parser.add_argument('--families', default=','.join(FAMILIES),
+                        help='comma-separated metric families to compute')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of warm-up jobs to run at once')
+    parser.add_argument('--quota-share', type=float, default=1.,
+                        help='fraction of the time (0-1] each worker may spend running jobs')
+    parser.add_argument('--watch', type=float, default=None, metavar='SECONDS',
+                        help='keep running, checking for dataset changes at this interval')
+    parser.add_argument('--queue', default=None,
+                        help='add the jobs to this worker pool job queue instead of running them')
+    args = parser.parse_args()
+    if not 0 < args.quota_share <= 1:
+        parser.error('--quota-share must be in (0, 1]')
+
+    store = ResultStore()
+    families = args.families.split(',')
+    versions = {}
+    while True:
+        # Only (re-)warm the families whose datasets changed since the last pass
+        current = dict((family, dataset_version(family)) for family in families)
+        changed = [family for family in families if versions.get(family) != current[family]]
+        if changed:
+            if args.queue:
+                enqueue(load_catalog(args.catalog), changed, JobQueue(args.queue))
+            else:
+                warm(load_catalog(args.catalog), changed, store, args.concurrency, args.quota_share)
+            versions = current
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
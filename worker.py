@@ -0,0 +1,263 @@
+# Worker pool for running the metric scripts over many AOIs, for batch runs and
+# cache warm-up.
+#
+# Jobs (a metric family and a geojson) are kept in a shared SQLite queue, which
+# stands in for a message broker: worker processes on one or several machines
+# claim jobs from it, run the metric script in-process with an Earth Engine
+# session initialized once per worker, and record the result. Results also go
+# to the shared result store (DT_RESULT_STORE), so interactive requests for the
+# same AOIs are served from it. Each worker can use a different service account
+# key to spread the Earth Engine quota. Workers report heartbeats for the job
+# they run as long as it makes progress; jobs held by a worker that stopped
+# reporting, and jobs that failed, are re-queued until they have been attempted
+# MAX_ATTEMPTS times. A worker whose job makes no progress for JOB_TIMEOUT
+# seconds fails the job and exits. Worker processes that exit, e.g. when a job
+# runs out of memory, are restarted.
+#
+#  To start four workers using two keys, enqueue a catalog of regions, and
+# check on progress:
+#
+#     python worker.py run jobs.db --workers 4 --keys key_a.json,key_b.json
+#     python warmup.py catalog.geojson --queue jobs.db
+#     python worker.py status jobs.db
+#
+#  When workers run on several machines the queue and the result store must be
+# on a shared filesystem that supports locking.
+
+import os
+import sys
+import json
+import time
+import runpy
+import socket
+import sqlite3
+import argparse
+import traceback
+import threading
+import multiprocessing
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from results import ResultStore, BACKGROUND, HERE, abandon_flights
+
+# Seconds between heartbeats, and number of missed heartbeats after which a
+# running job is re-queued
+HEARTBEAT = 10
+MISSED_HEARTBEATS = 6
+
+# Number of times a job is attempted before it is marked as failed
+MAX_ATTEMPTS = 3
+
+# Seconds a job may run without starting or finishing an Earth Engine query,
+# not counting time paused for interactive requests, before it is considered
+# stuck
+JOB_TIMEOUT = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    family TEXT NOT NULL,
+    name TEXT,
+    geojson TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, priority, id);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    key_file TEXT,
+    heartbeat REAL,
+    jobs_done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class JobQueue(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def enqueue(self, family, geojson, name=None, priority=0):
+        self._execute('INSERT INTO jobs (family, name, geojson, priority) VALUES (?, ?, ?, ?)',
+                      (family, name, geojson, priority))
+
+    def claim(self, worker):
+        # Take the queued job with the lowest priority value, marking it as
+        # running. BEGIN IMMEDIATE makes sure no two workers claim the same job.
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute("SELECT id, family, name, geojson FROM jobs WHERE status = 'queued' "
+                                      "ORDER BY priority, id LIMIT 1").fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?, "
+                                    "attempts = attempts + 1 WHERE id = ?", (worker, time.time(), row[0]))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return row
+
+    def heartbeat(self, worker, key_file=None, job_id=None):
+        now = time.time()
+        self._execute('INSERT OR IGNORE INTO workers (name) VALUES (?)', (worker,))
+        self._execute('UPDATE workers SET key_file = ?, heartbeat = ? WHERE name = ?',
+                      (key_file, now, worker))
+        if job_id is not None:
+            self._execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (now, job_id))
+
+    def finish(self, worker, job_id, result):
+        self._execute("UPDATE jobs SET status = 'done', result = ?, error = NULL WHERE id = ?",
+                      (result, job_id))
+        self._execute('UPDATE workers SET jobs_done = jobs_done + 1 WHERE name = ?', (worker,))
+
+    def fail(self, job_id, error):
+        self._execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                      "error = ? WHERE id = ?", (MAX_ATTEMPTS, error, job_id))
+
+    def requeue_stale(self):
+        # Re-queue jobs whose worker stopped sending heartbeats, or mark them as
+        # failed if they have used up their attempts, so that a job that kills
+        # its worker is not retried forever
+        self._execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                      "error = 'worker stopped sending heartbeats' WHERE status = 'running' AND heartbeat < ?",
+                      (MAX_ATTEMPTS, time.time() - HEARTBEAT * MISSED_HEARTBEATS))
+
+    def iter_results(self):
+        # Completed jobs as (family, name, result), read one at a time
+        for row in self.db.execute("SELECT family, name, result FROM jobs WHERE status = 'done' ORDER BY id"):
+            yield row
+
+    def status(self):
+        return {'jobs': dict(self._execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')),
+                'workers': dict((name, {'key_file': key_file, 'jobs_done': jobs_done,
+                                        'seconds_since_heartbeat': time.time() - heartbeat})
+                                for name, key_file, heartbeat, jobs_done in
+                                self._execute('SELECT name, key_file, heartbeat, jobs_done FROM workers'))}
+
+
+def run_script(family, geojson):
+    # Run a metric script in this process and return what it wrote to stdout.
+    # The scripts call initialize(), which only connects to Earth Engine on the
+    # first job.
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = [family + '.py', geojson]
+    sys.stdout = StringIO()
+    try:
+        try:
+            runpy.run_path(os.path.join(HERE, family + '.py'), run_name='__main__')
+        except SystemExit as e:
+            # Scripts exit early when the result is served from the store
+            if e.code:
+                raise RuntimeError('{} exited with {}'.format(family, e.code))
+        return sys.stdout.getvalue()
+    finally:
+        sys.argv, sys.stdout = argv, stdout
+
+
+def run_worker(name, queue_path, key_file=None, poll=5):
+    # Worker jobs are background work, so they pause between queries while
+    # interactive requests are being computed
+    os.environ['DT_PRIORITY'] = BACKGROUND
+    if key_file:
+        os.environ['DT_KEY_FILE'] = key_file
+    sys.path.insert(0, HERE)
+    import common
+    common.initialize()
+
+    queue = JobQueue(queue_path)
+    store = ResultStore()
+    current = {'job_id': None, 'progress': None}
+
+    def report_progress():
+        current['progress'] = time.time()
+    common.on_progress = report_progress
+
+    def send_heartbeats():
+        while True:
+            job_id = current['job_id']
+            if job_id is not None:
+                if not store.is_idle():
+                    # The job is paused for interactive requests
+                    report_progress()
+                elif time.time() - current['progress'] > JOB_TIMEOUT:
+                    # The job is stuck, e.g. in a query that never returns.
+                    # Fail it and exit, which releases its flight, and let the
+                    # pool start a new worker.
+                    queue.fail(job_id, 'no progress for {} seconds'.format(JOB_TIMEOUT))
+                    os._exit(1)
+            queue.heartbeat(name, key_file, job_id)
+            time.sleep(HEARTBEAT)
+    heartbeat_thread = threading.Thread(target=send_heartbeats)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    while True:
+        queue.requeue_stale()
+        store.wait_until_idle()
+        job = queue.claim(name)
+        if job is None:
+            time.sleep(poll)
+            continue
+        job_id, family, job_name, geojson = job
+        report_progress()
+        current['job_id'] = job_id
+        try:
+            queue.finish(name, job_id, run_script(family, geojson))
+        except Exception:
+            # The script failed before publishing its result, so let other
+            # processes waiting on the same AOI compute it
+            abandon_flights()
+            queue.fail(job_id, traceback.format_exc())
+        current['job_id'] = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run metric scripts from a shared job queue.')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='start worker processes')
+    run_parser.add_argument('queue', help='path to the SQLite job queue')
+    run_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='number of worker processes to start')
+    run_parser.add_argument('--keys', default=None,
+                            help='comma-separated service account key files, assigned to workers in turn')
+    status_parser = subparsers.add_parser('status', help='print job counts and worker heartbeats')
+    status_parser.add_argument('queue', help='path to the SQLite job queue')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        sys.stdout.write(json.dumps(JobQueue(args.queue).status(), indent=4, sort_keys=True))
+    elif args.command == 'run':
+        # Create the tables before starting the workers
+        JobQueue(args.queue)
+        keys = args.keys.split(',') if args.keys else [None]
+
+        def start_worker(n):
+            name = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), n)
+            p = multiprocessing.Process(target=run_worker, args=(name, args.queue, keys[n % len(keys)]))
+            p.start()
+            return p
+        processes = [start_worker(n) for n in range(args.workers)]
+        # Restart workers that exit, so that the pool keeps its size when a
+        # job kills its worker
+        while True:
+            time.sleep(HEARTBEAT)
+            for n, p in enumerate(processes):
+                if not p.is_alive():
+                    sys.stderr.write('worker {} exited with code {}, restarting\n'.format(n, p.exitcode))
+                    processes[n] = start_worker(n)
+    else:
+        parser.print_help()